@@ -1,11 +1,12 @@
 from os.path import exists
 import csv
-import time
 import requests
 import io 
 import gzip
 import sys
 
+from utils.ratelimit import get_limiter
+
 def list_warc_data(input_file):
     positions = []
     with open(input_file, newline='') as csvfile:
@@ -13,7 +14,7 @@ def list_warc_data(input_file):
         positions = [dict(r) for r in reader]
     return positions
 
-def donwload_one(warc_data, output_dir, timeout=1):
+def donwload_one(warc_data, output_dir):
     print(warc_data)
 
     # Skip if file data is empty
@@ -41,12 +42,16 @@ def donwload_one(warc_data, output_dir, timeout=1):
             "Range": f"bytes={offset}-{offset_end}"
     }
 
+    # Common Crawl answers with "Please reduce your request rate." when throttling,
+    # that is fed back into the limiter like a 503
+    limiter = get_limiter(url)
     try_num = 1
     while 1:
         print(f"Try to download {try_num}")
         try_num += 1
 
         content = ""
+        limiter.acquire()
         resp = requests.get(url, headers=headers)
         content = resp.content
 
@@ -58,12 +63,10 @@ def donwload_one(warc_data, output_dir, timeout=1):
         # l = f"Resp Length for {url}: {len(resp.text)}"
         # print(l)
 
-        time.sleep(timeout)
-
-        if b"Please reduce your request rate." in content:
+        status = 503 if b"Please reduce your request rate." in content else resp.status_code
+        if limiter.update(status, resp.headers):
             print()
-            print("TIMEOUT: %d" % timeout)
-            timeout = min(60, timeout*2)
+            print(f"THROTTLED: {limiter}")
             continue
 
         data = ""
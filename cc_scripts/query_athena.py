@@ -1,20 +1,14 @@
 import boto3
 import csv
 
+from utils.dates import GRID
+
 BOTO_SESSION = boto3.Session(
     aws_access_key_id="<that's my secret>",
     aws_secret_access_key="<that's my secret>",
     region_name = "us-east-1"
 )
 
-dates = ["20160115", "20160415", "20160715", "20161015",
-         "20170115", "20170415", "20170715", "20171015",
-         "20180115", "20180415", "20180715", "20181015",
-         "20190115", "20190415", "20190715", "20191015",
-         "20200115", "20200415", "20200715", "20201015",
-         "20210115", "20210415", "20210715", "20211015",
-         "20220115", "20220415", "20220715"]
-
 # Some of the month were not archived by CC
 crawls = [
   'CC-MAIN-2016-18', # April
@@ -58,7 +52,7 @@ with open('dataset.csv', newline='') as csvfile:
 
 domains = [d[1] for d in data]
 
-for year in [2016, 2017, 2018, 2019, 2020, 2021, 2022]:
+for year in GRID.years:
     query = """
     SELECT *
     FROM "ccindex"."ccindex"
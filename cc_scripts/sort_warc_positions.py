@@ -2,51 +2,37 @@ import csv
 import sys
 from datetime import datetime, timedelta
 
-dates = ["20160115", "20160415", "20160715", "20161015",
-         "20170115", "20170415", "20170715", "20171015",
-         "20180115", "20180415", "20180715", "20181015",
-         "20190115", "20190415", "20190715", "20191015",
-         "20200115", "20200415", "20200715", "20201015",
-         "20210115", "20210415", "20210715", "20211015",
-         "20220115", "20220415", "20220715"]
+import numpy
 
+from utils.dates import DateGrid
+
+# Every row is matched to its nearest date of the grid at once (DateGrid.nearest_many), rows outside the threshold
+# window around that date are skipped
 dates = ["20160115", "20220115"]
 
 def sort_positions(input_name, output_name, threshold=4):
-    hosts = {}
+    grid = DateGrid(dates, timedelta(weeks=threshold))
     # with open('athena_www.csv', newline='') as csvfile:
-    # Read all lines from the CSV and add it to hosts
+    # Read all lines from the CSV, every row can only be the best one for the dates within the threshold around it
     with open(input_name, newline='') as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            host_name = row["url_host_name"]
-            fetch_time = datetime.fromisoformat(row["fetch_time"])
-
-            # Add host for all dates if not existing, else update if better date
-            if host_name not in hosts:
-                date_entries = []
-                for d in dates:
-                    date_entries.append({
-                        "current": fetch_time,
-                        "goal": datetime.strptime(d, "%Y%m%d"),
-                        "content": row
-                    })
-                hosts[host_name] = date_entries
-            else:
-                for entry in hosts[host_name]:
-                    if abs(entry["current"] - entry["goal"]) > abs(fetch_time -  entry["goal"]):
-                        entry["current"] = fetch_time
-                        entry["content"] = row
-
-    # Empty all rows that are not in threshold
-    for host_name in hosts:
-        for entry in hosts[host_name]:
-            current = entry["current"]
-            goal = entry["goal"]
-            if abs(current - goal) > timedelta(weeks=threshold):
-                entry["current"] = None
-                entry["content"] = None
+        rows = list(csv.DictReader(csvfile))
+    fetch_times = [datetime.fromisoformat(row["fetch_time"]) for row in rows]
+    nearest = grid.nearest_many(fetch_times)
+    distance = numpy.abs(numpy.array(fetch_times, dtype="datetime64[us]") - grid.targets64[nearest])
+    valid = grid.in_window_many(fetch_times, nearest)
 
+    hosts = {}
+    for i, row in enumerate(rows):
+        host_name = row["url_host_name"]
+        if host_name not in hosts:
+            hosts[host_name] = [{"current": None, "goal": goal, "content": None, "distance": None}
+                                for goal in grid.targets]
+        if not valid[i]:
+            continue
+        # Update if better date
+        entry = hosts[host_name][nearest[i]]
+        if entry["distance"] is None or distance[i] < entry["distance"]:
+            entry.update(current=fetch_times[i], content=row, distance=distance[i])
 
     # Write all hosts to output
     with open(output_name, 'w', newline='') as csvfile:
@@ -1,10 +1,11 @@
 from warcio.archiveiterator import ArchiveIterator
-from hashlib import sha256
 import os
 import sys
-import gzip
 from multiprocessing import Pool
 
+from config import STREAM_CHUNK_SIZE
+from utils.storage import get_store
+
 STORAGE = "./data_for_maws"
 PROCESSES = 8
 
@@ -19,15 +20,9 @@ def worker(path):
 
             if record.rec_type != 'response':
                 return
-            content = record.content_stream().read()
-            content_hash = sha256(content).hexdigest()
-
-            file_dir = os.path.join(STORAGE, content_hash[0], content_hash[1])
-            if not os.path.exists(file_dir):
-                os.makedirs(file_dir)
-            file_path = os.path.join(file_dir, f"{content_hash}.gz")
-            with gzip.open(file_path, "wb") as fh:
-                fh.write(content)
+            # No size limit, the hash has to match the one warc_to_database.py computes for the same record
+            stream = record.content_stream()
+            get_store(STORAGE).put_stream(iter(lambda: stream.read(STREAM_CHUNK_SIZE), b""), max_size=None)
 def main():
     directory = sys.argv[1]
 
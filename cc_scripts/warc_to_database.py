@@ -7,6 +7,8 @@ from multiprocessing import Pool
 import sys
 import os
 
+from utils.dates import nearest
+
 DB_USER = "archive"
 DB_PWD = "archive"
 DB_HOST = "<database host>"
@@ -16,20 +18,7 @@ ARCH = "c-crawl"
 PROCESSES = 8
 
 def get_wish_date_from_actual_date(actual_date):
-    dates = ["20160115", "20160415", "20160715", "20161015",
-            "20170115", "20170415", "20170715", "20171015",
-            "20180115", "20180415", "20180715", "20181015",
-            "20190115", "20190415", "20190715", "20191015",
-            "20200115", "20200415", "20200715", "20201015",
-            "20210115", "20210415", "20210715", "20211015",
-            "20220115", "20220415", "20220715"]
-    
-    cur = datetime.now()
-    for date in dates:
-        d = datetime.strptime(date, "%Y%m%d")
-        if abs(d - actual_date) < abs(cur - actual_date):
-            cur = d
-    return cur
+    return nearest(actual_date)
 
 def parse_warc_file(path):
     with open(path, 'rb') as stream:
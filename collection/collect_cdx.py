@@ -1,15 +1,13 @@
-import gzip
-import os
-import signal
-from contextlib import contextmanager
-from hashlib import sha256
-import collections
-from multiprocessing import Pool
-
-import psycopg2 as psycopg2
+import threading
+
 import requests
 
-from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PWD, STORAGE, PREFIX
+from config import PREFIX, WORKER_BATCH
+from utils.cdx import query, dump_lines
+from utils.database import cursor
+from utils.jobs import JobQueue
+from utils.scheduler import get_pool, imap_unordered, pool_size, Throughput
+from utils.storage import get_store, report
 
 DATE = "20221107"
 
@@ -17,70 +15,72 @@ DEBUG = False
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.88 Safari/537.36'
 
 RELEVANT_HEADERS = {'x-frame-options', 'content-security-policy', 'strict-transport-security'}
+# Fields of the stored CDX answers (see updater_cdx)
+CDX_FIELDS = ("timestamp", "original", "statuscode")
 
-def raise_timeout(signum, frame):
-    if DEBUG:
-        print('Hard kill via signal!')
-        print(signum)
-        print(frame)
-    raise TimeoutError
-
-
-@contextmanager
-def timeout(seconds):
-    # Register a function to raise a TimeoutError on the signal.
-    signal.signal(signal.SIGALRM, raise_timeout)
-    # Schedule the signal to be sent after the specified seconds.
-    signal.alarm(seconds)
-    try:
-        yield
-    except TimeoutError:
-        pass
-    finally:
-        # Unregister the signal so it won't be triggered, if the timeout is not reached.
-        signal.signal(signal.SIGALRM, signal.SIG_IGN)
+def read_domains(tranco_file):
+    with open(tranco_file) as fh:
+        for row in fh:
+            id_, domain = row.strip().split(',')
+            yield domain, id_
 
 
 def collect_data(tranco_file):
-    chunks = collections.defaultdict(list)
-
-    CHUNKS = 4
-
-    with open(tranco_file) as fh:
-        domain_list = fh.readlines()
-        for i, row in enumerate(domain_list):
-            id_, domain = row.strip().split(',')
-            chunks[i % CHUNKS].append((id_, domain))
-
-    with Pool(CHUNKS) as p:
-        p.map(worker, chunks.values())
-
-def worker(chunk):
-    sess = requests.Session()
-    conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PWD)
-    conn.autocommit = True
-    cursor = conn.cursor()
-    for id_, domain in chunk:
-        url = f"https://web.archive.org/cdx/search/cdx?url={domain}&filter=statuscode:200&from=20221226&to=20221228" \
-              f"&output=json"
-        with timeout(60):
-            print(domain)
-            try:
-                resp = sess.get(url)
-                content = resp.content
-                content_hash = sha256(content).hexdigest()
-                file_dir = os.path.join(STORAGE, content_hash[0], content_hash[1])
-                if not os.path.exists(file_dir):
-                    os.makedirs(file_dir)
-                file_path = os.path.join(file_dir, f"{content_hash}.gz")
-                with gzip.open(file_path, "wb") as fh:
-                    fh.write(content)
-                cursor.execute("""
+    # One queue and the pooled connections of this process for all workers, the workers only query and store
+    queue = JobQueue("cdx_responses")
+    queue.seed(read_domains(tranco_file), "SELECT domain FROM cdx_responses")
+
+    WORKERS = pool_size(4)
+
+    def jobs():
+        for batch in queue.drain(WORKER_BATCH):
+            yield from batch
+
+    throughput = Throughput("collect_cdx")
+    with get_pool(WORKERS) as p:
+        for (job_id, domain, id_), (content_hash, error) in imap_unordered(p, fetch_answer, jobs(), workers=WORKERS,
+                                                                           throughput=throughput):
+            if error is not None:
+                queue.fail(job_id, error)
+                continue
+            with cursor() as cur:
+                cur.execute("""
                 INSERT INTO cdx_responses (tranco_id, domain, timestamp, content_hash) VALUES (%s, %s, NOW(), %s)
                 """, (id_, domain, content_hash))
-            except Exception as e:
-                print(e)
-        # time.sleep(1)
+            queue.complete(job_id)
+
+    print(throughput.report())
+    print(f"Content store: {report()}")
+    print(f"Queue: {queue.progress()}")
+    queue.close()
+
+sessions = threading.local()
+
+def last_per_day(rows):
+    # collapse=timestamp:8 of the CDX API would keep the first snapshot of every day, updater_cdx wants the last one
+    days = {}
+    for row in rows:
+        day = row[0][:8]
+        if day not in days or row[0] >= days[day][0]:
+            days[day] = row
+    for day in sorted(days):
+        yield days[day]
+
+def fetch_answer(job_id, domain, id_):
+    # Runs in the pool, returns (content_hash, error)
+    print(domain)
+    if not hasattr(sessions, "session"):
+        sessions.session = requests.Session()
+    try:
+        # Only the most recent snapshot of a day is used later on, the rows are streamed into the store page by page
+        rows = last_per_day(query(sessions.session, domain, fields=CDX_FIELDS, filters=["statuscode:200"],
+                                  start="20221226", end="20221228", timeout=60))
+        # CDX answers are parsed as JSON later on, so they are never cut off
+        content_hash, _, _ = get_store().put_stream(dump_lines(CDX_FIELDS, rows), max_size=None)
+    except Exception as e:
+        print(e)
+        return None, str(e)
+    return content_hash, None
 
 
 def main(tranco_file):
@@ -1,19 +1,22 @@
 from playwright.sync_api import sync_playwright
 from utils.database import get_conn
+from utils.ratelimit import get_limiter
+from utils.scheduler import Throughput
 from collections import defaultdict, Counter
-from multiprocessing import Pool
+import queue
 import random
+import threading
 import tldextract
-import time
 import json
+import os
 import re
 
 from tqdm import tqdm
 
-def chunks(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
+from config import DYNAMIC_BROWSERS, DYNAMIC_PAGES_PER_BROWSER, DYNAMIC_BLOCKED_TYPES, DYNAMIC_CACHE_DIR
+
+# Filter out static stuff from archive
+ARCHIVE_STATIC = "https://web.archive.org/_"
 
 def url_filter(url):
     matches = re.search(r"\d+([js,im,if,cs,mp,oe,wkr]+_)?\/([http:|https:]*\/\/.*)", url)
@@ -21,82 +24,188 @@ def url_filter(url):
         return matches.group(2)
     return url
 
-def run_playwright(playwright, urls):
-    chromium = playwright.chromium
-    browser = chromium.launch()
+def error_result(error):
+    return [
+        {"status": "error", "type": "error", "value": str(error)},
+        {"status": "info", "type": "info", "status_code": -1}
+    ]
+
+def capture(page):
+    """Records the requests of a page as they are made, keyed by the request object.
+
+    Responses and timings are attached to their own request in O(1), also for URLs that are requested several times.
+    Static files of the archive are dropped right away.
+    """
+    requests = {}
+
+    def on_request(request):
+        if request.url.startswith(ARCHIVE_STATIC):
+            return
+        requests[request] = {
+            "status": "success",
+            "type": "request",
+            "headers": request.headers,
+            "method": request.method,
+            "resource_type": request.resource_type,
+            "url": request.url
+        }
+
+    def on_response(response):
+        record = requests.get(response.request)
+        if record is not None:
+            record["response_status_code"] = response.status
+            record["response_headers"] = response.headers
+
+    def on_finished(request):
+        record = requests.get(request)
+        if record is not None:
+            record["timing"] = request.timing
+
+    page.on("request", on_request)
+    page.on("response", on_response)
+    page.on("requestfinished", on_finished)
+    return requests
+
+def route_action(request):
+    """"abort" for resource types we never analyse, "fulfill" (with an empty body) for the stylesheets, images and
+    fonts of the archive itself, None to load the request. Scripts of the archive are loaded, they rewrite the URLs
+    the page requests."""
+    if request.resource_type in DYNAMIC_BLOCKED_TYPES:
+        return "abort"
+    if request.url.startswith(ARCHIVE_STATIC) and request.resource_type != "script":
+        return "fulfill"
+    return None
+
+def route(route):
+    action = route_action(route.request)
+    if action == "abort":
+        route.abort()
+    elif action == "fulfill":
+        route.fulfill(status=200, body="")
+    else:
+        route.continue_()
+
+class BrowserSession:
+    """The long-lived browser of a worker.
+
+    With DYNAMIC_CACHE_DIR the pages share a persistent context in a profile of the worker (and its disk cache),
+    otherwise every page gets a fresh context with route interception.
+    """
+
+    def __init__(self, playwright, worker_id):
+        self.pages = 0
+        self.closed = False
+        if DYNAMIC_CACHE_DIR is None:
+            self.browser = playwright.chromium.launch()
+            self.browser.on("disconnected", self.on_close)
+            self.context = None
+        else:
+            self.browser = None
+            self.context = playwright.chromium.launch_persistent_context(
+                os.path.join(DYNAMIC_CACHE_DIR, f"worker-{worker_id}"))
+            self.context.on("close", self.on_close)
+
+    def on_close(self, _):
+        self.closed = True
 
-    result = defaultdict(list)
-    for url in tqdm(urls):
-        print(url)
-        time.sleep(5)
+    def expired(self):
+        return self.closed or self.pages >= DYNAMIC_PAGES_PER_BROWSER
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
         try:
-            page = browser.new_page()
-
-            page.on("request", lambda request: result[url].append({
-                        "status": "success",
-                        "type": "request",
-                        "headers": request.headers,
-                        "method": request.method,
-                        "resource_type": request.resource_type,
-                        "url": request.url
-                    }))
-
-            def handle_response(response):
-                for r in result[url]:
-                    if "url" in r and r["url"] == response.url:
-                        r["response_status_code"] = response.status
-                        r["response_headers"] = response.headers
-
-            page.on("response", handle_response)
-
-            res = page.goto(url, timeout=60000)
-            status_code = res.status
-            # Filter out static stuff from archive
-            result[url] = [r for r in result[url] if not r["url"].startswith("https://web.archive.org/_")]
-            result[url].append({"status": "info", "type": "info", "status_code": status_code})
-        except Exception as e:
-            print(e)
-            status_code = -1
-            result[url] = [
-                {"status": "error", "type": "error", "value": str(e)},
-                {"status": "info", "type": "info", "status_code": -1}
-            ]
-    browser.close()
+            (self.browser or self.context).close()
+        except Exception:
+            # Crashed, playwright cleans up the process
+            pass
 
+def visit(session, url):
+    if session.context is None:
+        # Every page gets its own context, so cookies and storage of one site never leak into the next one
+        context = session.browser.new_context()
+        context.route("**/*", route)
+    else:
+        context = session.context
+        context.clear_cookies()
+    page = None
+    try:
+        page = context.new_page()
+        requests = capture(page)
+        res = page.goto(url, timeout=60000)
+        status_code = res.status
+        # Requests that start after this point are not part of the result, like before
+        result = list(requests.values())
+        result.append({"status": "info", "type": "info", "status_code": status_code})
+    except Exception as e:
+        print(e)
+        result = error_result(e)
+    finally:
+        try:
+            if context is not session.context:
+                context.close()
+            elif page is not None:
+                page.close()
+        except Exception:
+            # The browser is gone, browser_worker starts a new one
+            pass
     return result
 
-def run(bucket, year):
+def browser_worker(worker_id, urls, results):
+    # One long-lived browser per worker, replaced after DYNAMIC_PAGES_PER_BROWSER pages or when it crashed.
+    # The sync API must only be used from the thread that started it, so every worker has its own playwright.
     with sync_playwright() as playwright:
-        result = run_playwright(playwright, bucket)
-    
-    conn = get_conn()
-    cur = conn.cursor()
-    for url in result:
-        external_requests = result[url]
-
-        status_code = -1
-        for req in external_requests:
-            if req["status"] == "info":
-                status_code = req["status_code"]
-
-        # print(external_requests)
-        for req in external_requests:
-            if req["status"] == "error":
-                cur.execute(f""" INSERT INTO dynamic_script_inclusions_{year} (url, status_code, request_url, request_site, result)
-                        VALUES (%s, %s, %s, %s, %s) """,
-                        (url, status_code, "ERROR", "ERROR", json.dumps(req)))
-            elif req["status"] == "success":
-                r_url = url_filter(req["url"])
-                out = tldextract.extract(r_url)
-                r_site = f"{out.domain}.{out.suffix}"
-                cur.execute(f""" INSERT INTO dynamic_script_inclusions_{year} (url, status_code, request_url, request_site, result, response_status_code, response_headers)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s) """,
-                        (url, status_code, r_url, r_site, json.dumps(req), req.get("response_status_code", -2), json.dumps(req.get("response_headers", {}))))
-    conn.commit()
-    cur.close()
-    conn.close()
+        session = None
+        while True:
+            url = urls.get()
+            if url is None:
+                break
+            try:
+                if session is None or session.expired():
+                    if session is not None:
+                        session.close()
+                    session = BrowserSession(playwright, worker_id)
+                # Replaces the fixed sleep before every page, the rate adapts to the answers of the archive
+                limiter = get_limiter(url)
+                limiter.acquire()
+                result = visit(session, url)
+                if result[-1]["status_code"] > 0:
+                    limiter.update(result[-1]["status_code"])
+                session.pages += 1
+            except Exception as e:
+                # A playwright error outside of the page (e.g. the browser died) costs this page, not the worker.
+                # main() waits for one result per URL, so every URL taken from the queue must get one.
+                print(f"[W-{worker_id}] {e}")
+                result = error_result(e)
+                if session is not None:
+                    session.close()
+                session = None
+            results.put((url, result))
+        if session is not None:
+            session.close()
+
+def store_result(cur, url, external_requests, year):
+    status_code = -1
+    for req in external_requests:
+        if req["status"] == "info":
+            status_code = req["status_code"]
+
+    # print(external_requests)
+    for req in external_requests:
+        if req["status"] == "error":
+            cur.execute(f""" INSERT INTO dynamic_script_inclusions_{year} (url, status_code, request_url, request_site, result)
+                    VALUES (%s, %s, %s, %s, %s) """,
+                    (url, status_code, "ERROR", "ERROR", json.dumps(req)))
+        elif req["status"] == "success":
+            r_url = url_filter(req["url"])
+            out = tldextract.extract(r_url)
+            r_site = f"{out.domain}.{out.suffix}"
+            cur.execute(f""" INSERT INTO dynamic_script_inclusions_{year} (url, status_code, request_url, request_site, result, response_status_code, response_headers)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s) """,
+                    (url, status_code, r_url, r_site, json.dumps(req), req.get("response_status_code", -2), json.dumps(req.get("response_headers", {}))))
 
-def main(year="2016"):
+def get_urls(year):
     conn = get_conn()
     cur = conn.cursor()
 
@@ -104,10 +213,10 @@ def main(year="2016"):
 
     query = f"SELECT DISTINCT url FROM dynamic_script_inclusions_{year}"
     cur.execute(query)
-    finished_urls = list(cur.fetchall())
+    finished_urls = {u for u, in cur.fetchall()}
 
     d = "2016-01-15" if year == "2016" else "2022-07-15"
-    
+
     query = f"""
         SELECT final_url FROM responses_neighbors
         WHERE date = '{d} 00:00:00'
@@ -115,15 +224,39 @@ def main(year="2016"):
     """
     cur.execute(query)
 
-    split = 10
-    urls = [u[0] for u in cur.fetchall() if u not in finished_urls]
+    urls = [u for u, in cur.fetchall() if u not in finished_urls]
     random.shuffle(urls)
-    buckets = chunks(urls, split)
     cur.close()
     conn.close()
+    return urls
+
+def main(year="2016", browsers=DYNAMIC_BROWSERS):
+    urls = get_urls(year)
 
-    for buck in buckets:
-        run(buck, year)
+    # Browsers run in their own processes, so the workers scale with the cores although they are threads here
+    todo = queue.Queue()
+    results = queue.Queue()
+    for url in urls:
+        todo.put(url)
+    workers = [threading.Thread(target=browser_worker, args=(i, todo, results), daemon=True) for i in range(browsers)]
+    for worker in workers:
+        todo.put(None)
+        worker.start()
+
+    # Results are stored as the pages finish, a restart skips the URLs that are already in the table
+    conn = get_conn()
+    cur = conn.cursor()
+    throughput = Throughput("collect_dynamic")
+    for _ in tqdm(urls):
+        url, result = results.get()
+        store_result(cur, url, result, year)
+        conn.commit()
+        throughput.add(year)
+    for worker in workers:
+        worker.join()
+    print(throughput.report())
+    cur.close()
+    conn.close()
 
 if __name__ == "__main__":
     year = input("Which table do you want to fill? 2016 or 2022?")
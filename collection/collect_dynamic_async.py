@@ -0,0 +1,123 @@
+from playwright.async_api import async_playwright
+from utils.database import get_conn
+from utils.ratelimit import get_limiter
+from utils.scheduler import Throughput
+from collection.collect_dynamic import capture, error_result, get_urls, route_action, store_result
+import asyncio
+
+from tqdm import tqdm
+
+from config import DYNAMIC_BROWSERS, DYNAMIC_CONTEXTS, DYNAMIC_PAGES_PER_BROWSER
+
+# Same crawl as collect_dynamic.py with the async API of playwright: one process drives DYNAMIC_BROWSERS browsers
+# with up to DYNAMIC_CONTEXTS pages each, while a writer task stores the finished pages.
+# Request capture, routing and the stored rows are shared with collect_dynamic.py.
+
+async def route(route):
+    action = route_action(route.request)
+    if action == "abort":
+        await route.abort()
+    elif action == "fulfill":
+        await route.fulfill(status=200, body="")
+    else:
+        await route.continue_()
+
+async def visit(browser, url):
+    # Every page gets its own context, so cookies and storage of one site never leak into the next one
+    context = await browser.new_context()
+    try:
+        await context.route("**/*", route)
+        page = await context.new_page()
+        requests = capture(page)
+        res = await page.goto(url, timeout=60000)
+        status_code = res.status
+        # Requests that start after this point are not part of the result, like before
+        result = list(requests.values())
+        result.append({"status": "info", "type": "info", "status_code": status_code})
+    except Exception as e:
+        print(e)
+        result = error_result(e)
+    finally:
+        try:
+            await context.close()
+        except Exception:
+            # The browser is gone, browser_worker starts a new one
+            pass
+    return result
+
+async def load(browser, url, results, slots):
+    try:
+        try:
+            limiter = get_limiter(url)
+            await limiter.acquire_async()
+            result = await visit(browser, url)
+            if result[-1]["status_code"] > 0:
+                limiter.update(result[-1]["status_code"])
+        except Exception as e:
+            # A playwright error outside of the page (e.g. the browser died) costs this page, not the whole crawl.
+            # The writer waits for one result per URL.
+            print(e)
+            result = error_result(e)
+        await results.put((url, result))
+    finally:
+        slots.release()
+
+async def browser_worker(playwright, worker_id, urls, results, contexts):
+    # One browser with up to `contexts` pages at a time, replaced after DYNAMIC_PAGES_PER_BROWSER pages or when it
+    # crashed. The pages of the old browser are finished before it is closed.
+    url = next(urls, None)
+    while url is not None:
+        try:
+            browser = await playwright.chromium.launch()
+        except Exception as e:
+            print(f"[W-{worker_id}] {e}")
+            await results.put((url, error_result(e)))
+            url = next(urls, None)
+            continue
+
+        slots = asyncio.Semaphore(contexts)
+        pages = []
+        while url is not None and len(pages) < DYNAMIC_PAGES_PER_BROWSER and browser.is_connected():
+            await slots.acquire()
+            pages.append(asyncio.create_task(load(browser, url, results, slots)))
+            url = next(urls, None)
+        await asyncio.gather(*pages)
+        try:
+            await browser.close()
+        except Exception:
+            pass
+
+def store(conn, url, result, year):
+    cur = conn.cursor()
+    store_result(cur, url, result, year)
+    conn.commit()
+    cur.close()
+
+async def writer(results, total, year):
+    # Results are stored as the pages finish, a restart skips the URLs that are already in the table.
+    # The inserts run in a thread, the browsers keep loading pages in the meantime.
+    conn = get_conn()
+    throughput = Throughput("collect_dynamic_async")
+    for _ in tqdm(range(total)):
+        url, result = await results.get()
+        await asyncio.to_thread(store, conn, url, result, year)
+        throughput.add(year)
+    print(throughput.report())
+    conn.close()
+
+async def crawl(year, browsers, contexts):
+    urls = get_urls(year)
+    todo = iter(urls)
+    # Bounded, so the browsers wait for the database instead of piling up results
+    results = asyncio.Queue(maxsize=browsers * contexts)
+    writing = asyncio.create_task(writer(results, len(urls), year))
+    async with async_playwright() as playwright:
+        # A failing writer stops the browsers as well
+        await asyncio.gather(writing, *(browser_worker(playwright, i, todo, results, contexts) for i in range(browsers)))
+
+def main(year="2016", browsers=DYNAMIC_BROWSERS, contexts=DYNAMIC_CONTEXTS):
+    asyncio.run(crawl(year, browsers, contexts))
+
+if __name__ == "__main__":
+    year = input("Which table do you want to fill? 2016 or 2022?")
+    main(year)
@@ -1,16 +1,9 @@
-import gzip
 import json
-import os
-import signal
-from contextlib import contextmanager
-from hashlib import sha256
-from multiprocessing import Pool
-from time import time_ns
 
-import psycopg2 as psycopg2
-import requests
-
-from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PWD, USER_AGENT, STORAGE
+from utils.database import connection, BatchWriter
+from utils.fetch import Job, run, header_dict
+from utils.jobs import JobQueue
+from utils.storage import report
 
 TABLE_NAME = 'live_headers'
 
@@ -18,8 +11,8 @@ DEBUG = False
 
 
 def setup():
-    with psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PWD) as connection:
-        with connection.cursor() as cursor:
+    with connection() as conn:
+        with conn.cursor() as cursor:
             cursor.execute(f"""
                 CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
                     id SERIAL PRIMARY KEY,
@@ -31,9 +24,11 @@ def setup():
                     timestamp TIMESTAMP DEFAULT NOW(),
                     duration NUMERIC DEFAULT NULL,
                     content_hash VARCHAR(64) DEFAULT NULL,
+                    truncated BOOLEAN DEFAULT FALSE,
                     status_code INT DEFAULT -1
                 );
             """)
+            cursor.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS truncated BOOLEAN DEFAULT FALSE")
 
             print(f'<<< CREATE INDEX ON {TABLE_NAME} >>>')
             for column in ['tranco_id', 'domain', 'start_url', 'end_url', 'timestamp', 'duration', 'content_hash',
@@ -41,87 +36,45 @@ def setup():
                 cursor.execute(f"CREATE INDEX ON {TABLE_NAME} ({column})")
 
 
-def raise_timeout(signum, frame):
-    if DEBUG:
-        print('Hard kill via signal!')
-        print(signum)
-        print(frame)
-    raise TimeoutError
-
-
-@contextmanager
-def timeout(seconds):
-    # Register a function to raise a TimeoutError on the signal.
-    signal.signal(signal.SIGALRM, raise_timeout)
-    # Schedule the signal to be sent after the specified seconds.
-    signal.alarm(seconds)
-    try:
-        yield
-    finally:
-        # Unregister the signal, so it won't be triggered, if the timeout is not reached.
-        signal.signal(signal.SIGALRM, signal.SIG_IGN)
-
-
-def crawl(url, headers=None, user_agent=USER_AGENT):
-    if headers is None:
-        headers = dict()
-    headers['User-Agent'] = user_agent
-
-    try:
-        with timeout(60):
-            start = time_ns()
-            r = requests.get(url, headers=headers, timeout=30)
-            duration = time_ns() - start
-    except TimeoutError:
-        return False, 'Hard kill due to signal timeout!'
-    except Exception as exp:
-        return False, str(exp)
-
-    content = r.content
-    content_hash = sha256(content).hexdigest()
-    file_dir = os.path.join(STORAGE, content_hash[0], content_hash[1])
-    if not os.path.exists(file_dir):
-        os.makedirs(file_dir)
-    file_path = os.path.join(file_dir, f"{content_hash}.gz")
-    with gzip.open(file_path, "wb") as fh:
-        fh.write(content)
-
-    response_headers = {h.lower(): r.headers[h] for h in r.headers}
-    response_headers = json.dumps(response_headers)
-
-    return True, [r.url, r.status_code, response_headers, content_hash, duration]
-
-
-def worker(id_, url):
-    success, data = crawl(url)
-    conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PWD)
-    conn.autocommit = True
-    cursor = conn.cursor()
-    if success:
-        end_url, status_code, headers, content_hash, duration = data
-        cursor.execute(f"""
-        INSERT INTO {TABLE_NAME} (tranco_id, domain, start_url, end_url, headers, duration, status_code, content_hash) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        """, (id_, url.split('.', 1)[1], url, end_url, headers, duration, status_code, content_hash))
-    else:
-        cursor.execute(f"""
-        INSERT INTO {TABLE_NAME} (tranco_id, domain, start_url, end_url) 
-        VALUES (%s, %s, %s, %s)
-        """, (id_, url.split('.', 1)[1], url, data))
-
-    conn.close()
+def store_result(writer, queue, job, result):
+    job_id, id_ = job.data
+    url = job.url
+    if result.error is None:
+        response_headers = json.dumps(header_dict(result.headers, lower=True))
+        writer.add((id_, url.split('.', 1)[1], url, result.url, response_headers, result.duration, result.status,
+                    result.content_hash, result.truncated), job_id)
+    elif not queue.fail(job_id, result.error):
+        writer.add((id_, url.split('.', 1)[1], url, result.error, None, None, -1, None, False))
 
 
-def collect_data(tranco_file):
-    urls = []
+def read_urls(tranco_file):
     with open(tranco_file) as file:
         for line in file:
             id_, domain = line.strip().split(',')
-            url = f"http://www.{domain}"
-            urls.append((id_, url))
+            yield f"http://www.{domain}", id_
 
-    with Pool(8) as p:
-        p.starmap(worker, urls)
+
+def collect_data(tranco_file):
+    queue = JobQueue(TABLE_NAME)
+    queue.seed(read_urls(tranco_file), f"SELECT start_url FROM {TABLE_NAME}")
+
+    def claim():
+        # All live jobs share one key, its workers live for the whole crawl and reuse the pooled HTTP connections
+        return [Job(url, key="live", data=(job_id, id_)) for job_id, url, id_ in queue.claim(1000)]
+
+    # Rows are committed in batches together with the completion of their jobs
+    writer = BatchWriter(f"""
+        INSERT INTO {TABLE_NAME} (tranco_id, domain, start_url, end_url, headers, duration, status_code, content_hash, truncated) 
+        VALUES %s
+    """, on_flush=lambda cur, job_ids: queue.complete_many(job_ids, cur))
+
+    with writer:
+        # Every host is visited once, so there is nothing to pace
+        run([], lambda job, result: store_result(writer, queue, job, result), refill=claim, paced=False)
+
+    print(f"Content store: {report()}")
+    print(f"Queue: {queue.progress()}")
+    queue.close()
 
 
 def main(tranco_file="live_dataset.csv"):
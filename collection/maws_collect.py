@@ -1,158 +1,223 @@
-import gzip
 import json
 import logging
-import os
-import time
 import traceback
-from multiprocessing import Process
-from datetime import datetime
 
-from bs4 import BeautifulSoup
 from collections import Counter, defaultdict
 from copy import deepcopy
 from datetime import datetime as dt
-from hashlib import sha256
-import requests
-
-from utils.database import get_conn
-from config import STORAGE, PREFIX, APIs
-
-session = requests.Session()
-
-
-def crawl_all(all_urls, table):
-    workers = []
-    for archive in all_urls.keys():
-        p = Process(target=collect_data, args=(archive, all_urls[archive], table))
-        p.start()
-        workers.append(p)
-
-    for p in workers:
-        p.join()
-    pass
-
-
-def check_redirect(archive, response):
-    # check if a redirect page is shown.
-    # if so, follow it
-    content = response.content
-    headers = [k.lower() for k in response.headers.keys()]
-
-    # If memento-timestamp exists and no x-archive-orig
-    # we have a redirect, else not
-    if not ("memento-datetime" in headers
-            and "x-archive-orig" not in "".join(headers)):
-        return ""
-
-    soup = BeautifulSoup(content, 'html.parser')
-
-    if archive == "congress":
-        results = soup.select("p[class='impatient']")
-        if len(results) == 0:
-            # not valid
-            return ""
-        redirect_url = str(results[0].find("a")['href'])
-    elif archive == "iceland":
-        results = soup.select("div[class='redirect']")
-        div = results[0].find("div")
-        redirect_url = str(div.find("a")['href'])
-    else:
-        # Other archives are negligible
-        redirect_url = ""
-    return redirect_url
-
-
-def collect_data(archive, urls, table):
-    # urls =  (url, date)
+
+from utils.database import get_conn, copy_rows
+from utils.dates import DATES, GRID
+from utils.fetch import Job, Stopped, run, header_dict
+from utils.jobs import JobQueue
+from utils.memento import parse_timemap, resolve
+from utils.scheduler import Progress
+from utils.storage import report
+from config import PREFIX, APIs, TIMEMAPS, SNAPSHOT_WINDOW_DAYS
+
+
+def setup(conn, table):
+    # Result tables created before bodies were streamed have no truncated flag
+    with conn.cursor() as cur:
+        cur.execute("ALTER TABLE " + table + " ADD COLUMN IF NOT EXISTS truncated BOOLEAN DEFAULT FALSE")
+
+
+def direct_jobs(queue):
+    # One request per (archive, date, url), the archive picks the snapshot
+    def claim():
+        jobs = []
+        for job_id, _, (archive, date, url) in queue.claim():
+            endpoint = APIs[archive].format(date=date, url=url)
+            jobs.append(Job(endpoint, key=archive, archive=archive, dict_key=archive, data=(job_id, url, [date])))
+        return jobs
+    return claim
+
+
+def memento_jobs(queue):
+    # One request per distinct memento, its response is stored for all dates it is the nearest snapshot of
+    def claim():
+        jobs = []
+        for job_id, _, (archive, timestamp, url, dates) in queue.claim():
+            endpoint = APIs[archive].format(date=timestamp, url=url)
+            jobs.append(Job(endpoint, key=archive, archive=archive, dict_key=archive, data=(job_id, url, dates)))
+        return jobs
+    return claim
+
+
+def crawl(queue, name, handle, claim, **kwargs):
+    # Runs until the queue is empty, the first Ctrl-C lets the requests in flight finish and gives the claimed but
+    # unstarted jobs back to the queue. Returns False if the crawl was stopped.
+    try:
+        run([], handle, refill=claim, graceful=True, **kwargs)
+    except Stopped as stopped:
+        print(f"Released {queue.release([job.data[0] for job in stopped.jobs])} jobs")
+        return False
+    except KeyboardInterrupt:
+        print("Caught KeyboardInterrupt, returning")
+        return False
+    finally:
+        print(f"{name}: {queue.progress()}")
+    return True
+
+
+def crawl_all(queue, table, claim=None):
+    # All archives are fetched by one event loop, every archive runs ARCHIVE_CONCURRENCY workers paced by its own
+    # rate limiter, so the crawl takes about as long as the slowest archive needs at its rate limit.
+    # Jobs are claimed from the queue in batches, so several collectors can share the crawl.
     conn = get_conn(True)
     cur = conn.cursor()
-
-    sess = requests.Session()
-    sess.headers["Connection"] = "Keep-Alive"
-
-    total = len(urls)
-
-    for i, url_date in enumerate(urls):
-        url, date = url_date
-        endpoint = APIs[archive].replace("[DATE]", date).replace("[URL]", url)
-        print(f"{i}/{total} - {endpoint}")
-        start = time.time()
-        try:
-            response = sess.get(endpoint, allow_redirects=True, stream=True, timeout=30)
-            for _ in range(3):
-                redirect_url = check_redirect(archive, response)
-                if redirect_url:
-                    response = sess.get(redirect_url, allow_redirects=True, stream=True, timeout=30)
-                    actual_date = datetime.strptime(redirect_url.split("/")[4], '%Y%m%d%H%M%S')
-                    redirect_url = check_redirect(archive, response)
-                    if not redirect_url:
-                        break
-        except KeyboardInterrupt:
-            print("Caught KeyboardInterrupt, returning")
+    progress = Progress(queue.name, queue.remaining())
+
+    def store_result(job, result):
+        job_id, url, dates = job.data
+        archive = job.archive
+        if result.error is not None:
+            if queue.fail(job_id, result.error):
+                return
+            for date in dates:
+                cur.execute("INSERT INTO " + table + " (arch,date,url,status,headers,final_url,error,runtime) "
+                                                          "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
+                            (archive, dt.strptime(date, '%Y%m%d'), url, -1,
+                             None, job.url, result.traceback, result.runtime))
+            progress.add(archive)
             return
-        except:
-            error = traceback.format_exc()
-            cur.execute("INSERT INTO " + table + " (arch,date,url,status,headers,final_url,error,runtime) "
-                                                      "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
-                        (archive, dt.strptime(date, '%Y%m%d'), url, -1,
-                         None, endpoint, error, time.time() - start))
-            time.sleep(2)
-            continue
-
-        content = response.content
-        content_hash = sha256(content).hexdigest()
-        file_dir = os.path.join(STORAGE, content_hash[0], content_hash[1])
-        if not os.path.exists(file_dir):
-            os.makedirs(file_dir)
-        file_path = os.path.join(file_dir, f"{content_hash}.gz")
-        with gzip.open(file_path, "wb") as fh:
-            fh.write(content)
-        response.close()
+
         try:
-            cur.execute("INSERT INTO " + table + "(arch,date,url,status,headers,final_url,runtime,content_hash) "
-                                                      "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
-                        (archive, dt.strptime(date, '%Y%m%d'), url, response.status_code,
-                         json.dumps(dict(response.headers)), response.url, time.time() - start, content_hash))
+            for date in dates:
+                cur.execute("INSERT INTO " + table + "(arch,date,url,status,headers,final_url,runtime,content_hash,truncated) "
+                                                          "VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)",
+                            (archive, dt.strptime(date, '%Y%m%d'), url, result.status,
+                             json.dumps(header_dict(result.headers)), result.url, result.runtime, result.content_hash,
+                             result.truncated))
         except:
             with open("/tmp/error.log", "a") as fh:
                 error = traceback.format_exc()
                 fh.write(error + "\n\n\n")
+        queue.complete(job_id)
+        progress.add(archive)
 
-        time.sleep(0.5)
+    finished = crawl(queue, "Queue", store_result, claim or direct_jobs(queue))
+    print(progress.report())
+    print(f"Content store: {report()}")
+    conn.close()
+    return finished
 
-def main(urls, table="responses"):
-    logging.basicConfig(level=logging.INFO)
 
-    conn = get_conn()
+def resolve_timemaps(queue, mementos, direct, table):
+    # Fetches one TimeMap per (archive, url) and queues the distinct mementos that are valid for at least one date.
+    # Dates without a memento in the window get an error row right away, archives that fail to deliver a (complete)
+    # TimeMap fall back to the direct requests.
+    conn = get_conn(True)
     cur = conn.cursor()
+    dates = dict(zip(GRID.targets, GRID.dates))
+    stats = Counter()
+    progress = Progress(queue.name, queue.remaining())
+
+    def claim():
+        return [Job(TIMEMAPS[archive].format(url=url), key=archive, data=(job_id, archive, url))
+                for job_id, _, (archive, url) in queue.claim()]
+
+    def store_result(job, result):
+        job_id, archive, url = job.data
+        if result.error is not None or result.status not in (200, 404):
+            if queue.fail(job_id, result.error or f"TimeMap status {result.status}"):
+                return
+            progress.add(archive)
+            stats["fallback"] += 1
+            direct.enqueue((f"{archive}|{date}|{url}", (archive, date, url)) for date in DATES)
+            return
+        if result.truncated:
+            # A TimeMap cut off at MAX_BODY_SIZE misses the later mementos, the archive picks the snapshots instead
+            direct.enqueue((f"{archive}|{date}|{url}", (archive, date, url)) for date in DATES)
+            queue.complete(job_id)
+            progress.add(archive)
+            stats["truncated"] += 1
+            return
+
+        found = []
+        if result.status == 200:
+            found = parse_timemap(result.body.decode("utf-8", errors="replace"))
+        resolved, missing = resolve(found, dates)
+        mementos.enqueue((f"{archive}|{memento:%Y%m%d%H%M%S}|{url}",
+                          (archive, f"{memento:%Y%m%d%H%M%S}", url, [dates[date] for date in served]))
+                         for memento, served in resolved.items())
+        for date in missing:
+            cur.execute("INSERT INTO " + table + " (arch,date,url,status,headers,final_url,error,runtime) "
+                                                      "VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
+                        (archive, date, url, -1, None, job.url,
+                         f"No memento within {SNAPSHOT_WINDOW_DAYS} days", result.runtime))
+        queue.complete(job_id)
+        progress.add(archive)
+        stats["timemaps"] += 1
+        stats["mementos"] += len(resolved)
+        stats["missing"] += len(missing)
+
+    # TimeMaps are parsed once and never read again, they stay out of the content store
+    finished = crawl(queue, "TimeMaps", store_result, claim, in_memory=True)
+    print(f"TimeMaps: {dict(stats)}")
+    conn.close()
+    return finished
+
+
+def load_urls(conn, urls):
+    # The URLs of interest go into a temporary table, the cross product with archives and dates is only built by
+    # the database (see pending_query)
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS pending_urls")
+        cur.execute("CREATE TEMP TABLE pending_urls (url TEXT PRIMARY KEY)")
+        copy_rows(cur, "pending_urls", ["url"], ((url,) for url in dict.fromkeys(urls)))
+        cur.execute("ANALYZE pending_urls")
+
+
+def pending_query(table, with_dates=True):
+    # (key, payload) of every (archive, date, url) without a row in the result table, an anti-join instead of
+    # loading the result table into memory. Without dates a URL only counts as done once it has a row of any date.
+    if with_dates:
+        return """
+        SELECT a.arch || '|' || d.date || '|' || u.url, jsonb_build_array(a.arch, d.date, u.url)
+        FROM pending_urls u CROSS JOIN unnest(%s::text[]) AS a (arch) CROSS JOIN unnest(%s::text[]) AS d (date)
+        WHERE NOT EXISTS (SELECT FROM """ + table + """ r
+                          WHERE r.arch = a.arch AND r.url = u.url AND r.date = to_date(d.date, 'YYYYMMDD'))
+        """
+    return """
+    SELECT a.arch || '|' || u.url, jsonb_build_array(a.arch, u.url)
+    FROM pending_urls u CROSS JOIN unnest(%s::text[]) AS a (arch)
+    WHERE NOT EXISTS (SELECT FROM """ + table + """ r WHERE r.arch = a.arch AND r.url = u.url)
+    """
+
+
+def main(urls, table="responses", mode="direct"):
+    logging.basicConfig(level=logging.INFO)
 
     urls_file = open(urls, "r")
     urls = ['http://' + PREFIX+ u.strip().split(',')[1] for u in urls_file.readlines()]
 
-    all_urls = defaultdict(set)
-
-    cur.execute("""
-    SELECT arch, date, url FROM """ + table + """
-    """)
-
-    known = set([f"{x[0]}|{x[1].strftime('%Y%m%d')}|{x[2]}" for x in cur.fetchall()])
-
-    dates = ["20160115", "20160415", "20160715", "20161015",
-             "20170115", "20170415", "20170715", "20171015",
-             "20180115", "20180415", "20180715", "20181015",
-             "20190115", "20190415", "20190715", "20191015",
-             "20200115", "20200415", "20200715", "20201015",
-             "20210115", "20210415", "20210715", "20211015",
-             "20220115", "20220415", "20220715"]
-
-    for url in urls:
-        for archive in APIs:
-            for date in dates:
-                url_id = f"{archive}|{date}|{url}"
-                if url_id not in known:
-                    all_urls[archive].add((url, date))
-
-    crawl_all(all_urls, table)
+    # The pending work is computed by the database and added to the job queue on every run, URLs and archives that
+    # are new since the last run are picked up, the collectors claim the jobs batch by batch
+    queue = JobQueue(table)
+    setup(queue.conn, table)
+    load_urls(queue.conn, urls)
+
+    if mode == "timemap":
+        # Resolve all dates of a URL against the TimeMap of each archive and fetch every valid memento once
+        timemaps = JobQueue(f"{table}:timemap", conn=queue.conn)
+        mementos = JobQueue(f"{table}:mementos", conn=queue.conn)
+        added = timemaps.enqueue_query(pending_query(table, with_dates=False),
+                                       ([archive for archive in APIs if archive in TIMEMAPS],))
+        print(f"{added} TimeMaps queued")
+        added = queue.enqueue_query(pending_query(table),
+                                    ([archive for archive in APIs if archive not in TIMEMAPS], DATES))
+        print(f"{added} jobs queued")
+        # A stopped phase is picked up again by the next run
+        if resolve_timemaps(timemaps, mementos, queue, table) and crawl_all(mementos, table, memento_jobs(mementos)):
+            # Archives without a usable TimeMap
+            crawl_all(queue, table)
+        queue.close()
+        return
+
+    print(f"{queue.enqueue_query(pending_query(table), (list(APIs), DATES))} jobs queued")
+    crawl_all(queue, table)
+    queue.close()
 
 
 if __name__ == "__main__":
@@ -7,6 +7,87 @@ RELEVANT_HEADERS = ['x-frame-options', 'content-security-policy', 'strict-transp
 USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/100.0.4896.88 Safari/537.36'
 
 STORAGE = "/data/"
+# "pack" appends bodies to pack segments, "loose" keeps one <h0>/<h1>/<hash>.gz file per body
+STORAGE_LAYOUT = "pack"
+# Pack segments are rolled over once they reach this size
+STORAGE_SEGMENT_SIZE = 1024 ** 3
+# "gzip" or "zstd", readers handle both. zstd uses the dictionaries trained with `python -m utils.storage train`
+STORAGE_CODEC = "gzip"
+ZSTD_LEVEL = 10
+ZSTD_DICT_SIZE = 112640
+ZSTD_DICT_SAMPLES = 2000
+# Bodies are read in chunks of this size and cut off (and flagged as truncated) after MAX_BODY_SIZE bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_BODY_SIZE = 32 * 1024 ** 2
+
+# Wayback CDX API, and the local copy of its index (utils/cdx_index.py) with one file per URL
+CDX_API = "https://web.archive.org/cdx/search/cdx"
+# Rows per CDX request, longer answers are paginated with resume keys (utils/cdx.py)
+CDX_PAGE_SIZE = 10000
+CDX_INDEX = STORAGE + "cdx_index/"
+
+# FETCHING (utils/fetch.py)
+FETCH_CONCURRENCY = 256
+# Requests in flight per archive (or per host), ARCHIVE_CONCURRENCY overrides single archives, the 'live' crawl and
+# the snapshots of updater_cdx ('cdx').
+# Workers wait for their rate limiter before they take a connection, so an archive needs about
+# (requests per second it tolerates) x (seconds per response) workers, more only queue up at the limiter.
+FETCH_HOST_CONCURRENCY = 8
+ARCHIVE_CONCURRENCY = {'live': 256, 'archiveorg': 32, 'arquivo': 4, 'stanford': 4, 'israel': 4, 'cdx': 32}
+# Hard limit for a whole fetch including archive redirects and the body, the others apply per socket operation
+FETCH_DEADLINE = 60
+FETCH_CONNECT_TIMEOUT = 30
+FETCH_READ_TIMEOUT = 30
+
+# Fetch-bound collectors run their workers as "thread"s of one process or as one "process" each (utils/scheduler.py)
+POOL_MODE = "thread"
+THREADS = 64
+# Jobs handed to a worker before it finished the previous ones, and seconds between throughput reports
+SCHEDULER_WINDOW = 2
+# Jobs a single pool worker claims from the job queue at once, small batches keep the tail short
+WORKER_BATCH = 10
+SCHEDULER_REPORT_INTERVAL = 60
+
+# DYNAMIC CRAWLS (collect_dynamic.py, collect_dynamic_async.py)
+# Browsers that load pages at the same time, each one is restarted after DYNAMIC_PAGES_PER_BROWSER pages
+DYNAMIC_BROWSERS = 8
+DYNAMIC_PAGES_PER_BROWSER = 100
+# Resource types that are never analysed, their requests are aborted (they are still recorded, without a response).
+# Images are loaded, tracking pixels and image loads are part of the collected data
+DYNAMIC_BLOCKED_TYPES = ["font", "media"]
+# Directory for one persistent profile per browser, so its pages share a disk cache (None: a fresh context per page).
+# Playwright turns the HTTP cache off as soon as requests are routed, so with a cache nothing is blocked.
+DYNAMIC_CACHE_DIR = None
+# Pages every browser of the async engine loads at the same time, each in a fresh context (DYNAMIC_CACHE_DIR is unused)
+DYNAMIC_CONTEXTS = 4
+# Engine of the dynamic crawl in main.py, "sync" (collect_dynamic.py) or "async" (collect_dynamic_async.py)
+DYNAMIC_ENGINE = "sync"
+
+# RATE LIMITING (utils/ratelimit.py)
+# Initial requests per second per archive host, RATE_LIMITS overrides single hosts
+RATE_LIMIT = 2
+RATE_LIMITS = {'web.archive.org': 5, 'data.commoncrawl.org': 1}
+RATE_MIN = 0.05
+RATE_MAX = 50
+RATE_BURST = 5
+# AIMD: add RATE_INCREASE req/s per answer, multiply by RATE_DECREASE on a 429/503
+RATE_INCREASE = 0.02
+RATE_DECREASE = 0.5
+# The rate is decreased at most once per this many seconds (or 1/rate if that is longer), the 429s of requests that
+# were already in flight belong to the same overload
+RATE_DECREASE_WINDOW = 2
+# Upper bound for Retry-After waits in seconds
+RATE_MAX_BACKOFF = 600
+# How often a throttled request is repeated before its answer is stored
+RATE_RETRIES = 3
+
+# JOB QUEUE (utils/jobs.py)
+# Jobs claimed per batch, seconds until an unextended lease runs out, attempts before a job is marked failed
+JOB_BATCH = 100
+JOB_LEASE = 600
+JOB_MAX_ATTEMPTS = 3
+# CDX answers updater_cdx claims at once
+UPDATER_CDX_BATCH = 50
 
 # DATABASE
 DB_USER = 'archive'
@@ -14,6 +95,12 @@ DB_PWD = 'archive'
 DB_HOST = 'localhost'
 DB_PORT = 5432
 DB_NAME = 'XXX'
+# Connections per process in the pool of utils/database.py
+DB_POOL_MIN = 1
+DB_POOL_MAX = 16
+# BatchWriter commits after this many rows or seconds, whatever comes first
+DB_BATCH_SIZE = 500
+DB_BATCH_INTERVAL = 5
 
 DEBUG = False
 
@@ -32,4 +119,17 @@ APIs = {
     'stanford': 'https://swap.stanford.edu/{date}mp_/{url}',
     'archiveorg': 'https://web.archive.org/web/{date}/{url}',
     # 'memento': 'https://timetravel.mementoweb.org/memento/{date}/{url}'
-}
\ No newline at end of file
+}
+# Memento TimeMaps (link format) of the archives above, used by `maws_collect` in "timemap" mode.
+# Archives without an entry are queried once per date.
+TIMEMAPS = {
+    'archive-it': 'https://wayback.archive-it.org/all/timemap/link/{url}',
+    'israel': 'http://wayback.nli.org.il:8080/timemap/link/{url}',
+    'iceland': 'http://wayback.vefsafn.is/wayback/timemap/link/{url}',
+    'congress': 'https://webarchive.loc.gov/all/timemap/link/{url}',
+    'arquivo': 'https://arquivo.pt/wayback/timemap/link/{url}',
+    'stanford': 'https://swap.stanford.edu/timemap/link/{url}',
+    'archiveorg': 'https://web.archive.org/web/timemap/link/{url}',
+}
+# Snapshots further away from the requested date are treated as invalid (updater.set_valid) or not fetched at all
+SNAPSHOT_WINDOW_DAYS = 42
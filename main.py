@@ -1,5 +1,6 @@
-from collection import collect_dynamic, collect_historical_data, maws_collect, collect_neighbors_1, collect_neighbors_2, collect_cdx, collect_live_data, collect_archive_data_for_fixed_date
+from collection import collect_dynamic, collect_dynamic_async, collect_historical_data, maws_collect, collect_neighbors_1, collect_neighbors_2, collect_cdx, collect_live_data, collect_archive_data_for_fixed_date
 from updater import updater_dynamic, content_analysis, updater, updater_neighbors, updater_cdx
+from config import DYNAMIC_ENGINE
 
 # Section 3
 def common_crawl():
@@ -8,7 +9,8 @@ def common_crawl():
 def other_archives():
     urls = input("URLs of interest (file): ")
     table_name = input("What is the table name (e.g. responses)")
-    maws_collect.main(urls, table_name)
+    timemaps = input("Resolve snapshots via TimeMaps? (y/n) ")
+    maws_collect.main(urls, table_name, "timemap" if timemaps.strip().lower() == "y" else "direct")
     updater.main(table_name, "archive")
 
 # Section 4
@@ -20,7 +22,10 @@ def neighborhoods():
 
 def dynamic_data():
     year = input("Which table do you want to fill? 2016 or 2022? ")
-    collect_dynamic.main(year)
+    if DYNAMIC_ENGINE == "async":
+        collect_dynamic_async.main(year)
+    else:
+        collect_dynamic.main(year)
     updater_dynamic.main(year)
     
 # Section 5
@@ -19,6 +19,7 @@ CREATE TABLE cdx_archive_headers (
     headers jsonb,
     "timestamp" timestamp without time zone DEFAULT now(),
     content_hash character varying(64) DEFAULT NULL::character varying,
+    truncated boolean DEFAULT false,
     status_code integer DEFAULT '-1'::integer
 );
 
@@ -80,10 +81,26 @@ CREATE TABLE historical_data (
     headers jsonb,
     "timestamp" timestamp without time zone DEFAULT now(),
     content_hash character varying(64) DEFAULT NULL::character varying,
+    truncated boolean DEFAULT false,
     status_code integer DEFAULT '-1'::integer,
     duration integer
 );
 
+CREATE TABLE job_queue (
+    id BIGSERIAL PRIMARY KEY,
+    queue character varying(128) NOT NULL,
+    key text NOT NULL,
+    payload jsonb,
+    status character varying(8) DEFAULT 'pending'::character varying,
+    attempts integer DEFAULT 0,
+    leased_by character varying(128) DEFAULT NULL::character varying,
+    lease_until timestamp without time zone,
+    error text,
+    updated timestamp without time zone DEFAULT now(),
+    priority integer DEFAULT 0,
+    UNIQUE (queue, key)
+);
+
 CREATE TABLE live_headers (
     id SERIAL,
     tranco_id integer,
@@ -93,6 +110,7 @@ CREATE TABLE live_headers (
     headers jsonb,
     "timestamp" timestamp without time zone DEFAULT now(),
     content_hash character varying(64) DEFAULT NULL::character varying,
+    truncated boolean DEFAULT false,
     status_code integer DEFAULT '-1'::integer,
     script_info jsonb,
     security_headers jsonb,
@@ -116,6 +134,7 @@ CREATE TABLE responses (
     error text,
     runtime double precision,
     content_hash character varying(64),
+    truncated boolean DEFAULT false,
     valid boolean DEFAULT false,
     valid_html boolean DEFAULT false,
     valid_headers boolean DEFAULT false,
@@ -179,6 +198,7 @@ CREATE TABLE responses_neighbors (
     error text,
     runtime double precision,
     content_hash character varying(64),
+    truncated boolean DEFAULT false,
     valid boolean DEFAULT false,
     valid_html boolean DEFAULT false,
     valid_headers boolean DEFAULT false,
@@ -209,6 +229,7 @@ CREATE TABLE web_archive_headers (
     headers jsonb,
     "timestamp" timestamp without time zone DEFAULT now(),
     content_hash character varying(64) DEFAULT NULL::character varying,
+    truncated boolean DEFAULT false,
     status_code integer DEFAULT '-1'::integer
 );
 
@@ -0,0 +1,24 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip("zstandard")
+pytest.importorskip("psycopg2")
+
+from utils.storage import ContentStore
+
+
+def test_concurrent_zstd_writers_round_trip(tmp_path):
+    # Like store_body in utils.fetch: all writers are opened on one thread, their chunks are compressed in a pool
+    store = ContentStore(str(tmp_path), codec="zstd")
+    bodies = [os.urandom(1024) * 64 + bytes([i]) * 4096 for i in range(20)]
+    writers = [store.writer() for _ in bodies]
+    with ThreadPoolExecutor(8) as pool:
+        # Every writer has one write in flight at a time, on whichever thread is free
+        for i in range(0, len(bodies[0]), 4096):
+            list(pool.map(lambda writer, body: writer.write(body[i:i + 4096]), writers, bodies))
+    hashes = [writer.commit() for writer in writers]
+
+    assert [store.get(content_hash) for content_hash in hashes] == bodies
+    store.close()
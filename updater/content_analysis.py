@@ -4,11 +4,10 @@ import tldextract
 from pprint import pprint
 from psycopg2 import connect
 from psycopg2.extras import Json
-import gzip
-import os
 import re
 
-from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PWD, PROCESSES, APIs, STORAGE, PREFIX
+from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PWD, PROCESSES, APIs, PREFIX
+from utils.storage import open_content
 
 def js_url_filter(url):
     # Explanation:
@@ -56,8 +55,7 @@ def urls_to_dict(urls, end_url):
 
 def worker_update_table_with_documents(hash, end_url, id, arch, table):
     print(f"Do {hash}")
-    path = os.path.join(STORAGE, hash[0], hash[1], f"{hash}.gz")
-    with gzip.open(path, "r") as f:
+    with open_content(hash) as f:
         html = f.read()
     urls = extract_src_urls(html)
 
@@ -1,14 +1,13 @@
-import gzip
 import json
-import os
 
 import multiprocessing
 import urllib3
 
 from utils.headers import classify_headers
 from utils.database import get_conn
+from utils.storage import copy_lengths
 
-from config import PROCESSES, STORAGE
+from config import PROCESSES, SNAPSHOT_WINDOW_DAYS
 
 args = None
 
@@ -30,7 +29,7 @@ def set_valid(table, reset=False):
 
     cur.execute(f"""
     UPDATE {table} SET valid = True 
-    WHERE abs(EXTRACT(epoch FROM date - actual_date)) < 60*60*24 * 42 
+    WHERE abs(EXTRACT(epoch FROM date - actual_date)) < 60*60*24 * {SNAPSHOT_WINDOW_DAYS} 
     AND actual_date IS NOT NULL
     AND NOT valid;
     """)
@@ -107,21 +106,33 @@ def update_length(table):
     conn = get_conn(True)
     cur = conn.cursor()
 
-    while True:
-        cur.execute("""
-        SELECT id, content_hash FROM """ + table + """  WHERE length IS NULL and status != -1 LIMIT 10000
-        """)
+    # Lengths come from the content store's sidecar metadata, so no blob has to be decompressed.
+    # They are loaded into a temporary table and applied with a single UPDATE.
+    read_conn = get_conn()
+    hashes = read_conn.cursor(name="update_length")
+    hashes.execute("""
+    SELECT DISTINCT content_hash FROM """ + table + """ WHERE length IS NULL AND status != -1 AND content_hash IS NOT NULL
+    """)
 
-        if cur.rowcount == 0:
+    loaded = 0
+    while True:
+        batch = [content_hash for content_hash, in hashes.fetchmany(100000)]
+        if not batch:
             break
+        loaded += copy_lengths(cur, batch)
+        print(f"Loaded {loaded} lengths")
+    hashes.close()
+    read_conn.close()
 
-        print(f"Updating {cur.rowcount} rows")
-        for r_id, content_hash in cur.fetchall():
-            file_dir = os.path.join(STORAGE, content_hash[0], content_hash[1])
-            file_path = os.path.join(file_dir, f"{content_hash}.gz")
-            with gzip.open(file_path) as fh:
-                length = len(fh.read())
-                cur.execute("UPDATE " + table + "  SET length=%s WHERE id=%s", (length, r_id))
+    if loaded == 0:
+        return
+
+    cur.execute("""
+    UPDATE """ + table + """ t SET length = c.length FROM content_lengths c
+    WHERE t.content_hash = c.content_hash AND t.length IS NULL AND t.status != -1
+    """)
+    print(f"Updated {cur.rowcount} rows")
+    cur.execute("DROP TABLE content_lengths")
 
 
 def update_trackers(table):
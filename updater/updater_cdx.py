@@ -1,18 +1,15 @@
-import gzip
 import json
-import os.path
 from collections import defaultdict
-from hashlib import sha256
 from json import JSONDecodeError
-from multiprocessing import Process
-from time import sleep
 
-import requests
 from psycopg2 import connect
 
-from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PWD, STORAGE, APIs
-
-SESSION = requests.Session()
+from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PWD, APIs, UPDATER_CDX_BATCH
+from utils.cdx import records
+from utils.database import BatchWriter, cursor
+from utils.fetch import Job, run, header_dict
+from utils.jobs import JobQueue
+from utils.storage import open_content, report
 
 
 def setup():
@@ -30,6 +27,7 @@ def setup():
                     headers JSONB,
                     timestamp TIMESTAMP DEFAULT NOW(),
                     content_hash varchar(64) DEFAULT NULL,
+                    truncated boolean DEFAULT FALSE,
                     status_code int default -1
                 );
             """)
@@ -37,135 +35,147 @@ def setup():
             for column in ['cdx_responses_id', 'start_url', 'end_url', 'timestamp', 'content_hash', 'status_code']:
                 cursor.execute(f"CREATE INDEX ON cdx_archive_headers ({column})")
             cursor.execute('CREATE UNIQUE INDEX ON cdx_archive_headers (cdx_responses_id, url_date)')
+            add_columns(cursor)
 
             print('<<< SETUP COMPLETE >>>')
 
 
-def get_first_200_data(data):
+def get_first_200_data(rows):
+    # The most recent snapshot with status code 200 of every day, rows are read one by one from the stored answer
     result = {}
-    for idx, entry in reversed(list(enumerate(data, start=1))):
-        date = entry[1][:8]
-        if entry[4] == "200" and date not in result:
-            result[entry[1][:8]] = idx
+    for row in rows:
+        if row["statuscode"] == "200":
+            result[row["timestamp"][:8]] = (row["timestamp"], row["original"])
     return result
 
 
-def worker(worker_id, timeout):
-    print(f'Worker {worker_id} started ...')
+def claim_batch(queue):
+    # Stage 1: claim a batch of stored CDX answers, copy the snapshots that are already known and return the
+    # endpoints that still have to be fetched
+    while True:
+        batch = queue.claim(UPDATER_CDX_BATCH)
+        if not batch:
+            return [], []
+
+        wanted = []
+        done = []
+        for job_id, _, (cdx_id, content_hash) in batch:
+            # Answers stored by older versions of collect_cdx carry all CDX fields, newer ones only the used ones
+            with open_content(content_hash) as file:
+                try:
+                    # get most recent 200 result
+                    first_200_data = get_first_200_data(records(file))
+                except JSONDecodeError:
+                    done.append((job_id, cdx_id, "empty json"))
+                    continue
+            if not first_200_data:
+                done.append((job_id, cdx_id, "no snapshot with status code 200"))
+                continue
+            wanted.append((job_id, cdx_id, [(date, APIs['archiveorg'].format(date=timestamp, url=url))
+                                             for date, (timestamp, url) in first_200_data.items()]))
+
+        # Snapshots that were already fetched for another domain are copied (index on end_url)
+        endpoints = list({endpoint for _, _, snapshots in wanted for _, endpoint in snapshots})
+        with cursor() as cur:
+            cur.execute("""
+                SELECT DISTINCT ON (end_url) end_url, headers, content_hash, truncated, status_code
+                FROM cdx_archive_headers WHERE end_url = ANY(%s)
+            """, (endpoints,))
+            known = {end_url: row for end_url, *row in cur.fetchall()}
+            for job_id, cdx_id, error in done:
+                cur.execute("UPDATE cdx_responses SET parsed=TRUE, error=%s WHERE id=%s;", (error, cdx_id))
+            queue.complete_many([job_id for job_id, _, _ in done], cur)
+
+        copies = []
+        jobs = []
+        for job_id, cdx_id, snapshots in wanted:
+            # Counts down to the last snapshot of the answer, which completes its job (see update_cdx.store)
+            row = {"job": job_id, "left": len(snapshots)}
+            for date, endpoint in snapshots:
+                if endpoint in known:
+                    response_headers, content_hash, truncated, status_code = known[endpoint]
+                    copies.append((row, cdx_id, (cdx_id, date, endpoint, endpoint, json.dumps(response_headers),
+                                                 content_hash, truncated, status_code)))
+                else:
+                    jobs.append(Job(endpoint, key="cdx", data=(row, cdx_id, date)))
+        if jobs or copies:
+            return jobs, copies
+
+
+def add_columns(cursor):
+    # Tables created before bodies were streamed have no truncated flag
+    cursor.execute("ALTER TABLE cdx_archive_headers ADD COLUMN IF NOT EXISTS truncated BOOLEAN DEFAULT FALSE")
+
+
+def ensure_schema():
+    # setup() is not repeatable, existing tables get the new column and the index here.
+    # The lookup of known snapshots must not scan the table (same name as the index created by setup)
     with connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PWD) as connection:
-        connection.autocommit = False
         with connection.cursor() as cursor:
-            while True:
-                cursor.execute("BEGIN;")
-                cursor.execute(
-                    "SELECT id, content_hash FROM cdx_responses WHERE NOT parsed AND status_code=200 LIMIT 1 FOR UPDATE SKIP LOCKED;")
-                result = cursor.fetchone()
-                if result is None:
-                    cursor.execute("COMMIT;")
-                    cursor.execute("END;")
-                    break
-
-                cdx_id, content_hash = result
-
-                with gzip.open(os.path.join(STORAGE, content_hash[0], content_hash[1], f"{content_hash}.gz")) as file:
-                    try:
-                        data = json.load(file)
-                    except JSONDecodeError:
-                        cursor.execute("UPDATE cdx_responses SET parsed=TRUE, error=%s WHERE id=%s;",
-                                       ("empty json", cdx_id))
-                        cursor.execute("COMMIT;")
-                        cursor.execute("END;")
-                        continue
-
-                if not data:
-                    cursor.execute("UPDATE cdx_responses SET parsed=TRUE, error=%s WHERE id=%s;",
-                                   ("empty json", cdx_id))
-                    cursor.execute("COMMIT;")
-                    cursor.execute("END;")
-                    continue
-
-                # get most recent 200 result
-                first_200_data = get_first_200_data(data[1:])
-                if not first_200_data:
-                    cursor.execute("UPDATE cdx_responses SET parsed=TRUE, error=%s WHERE id=%s;",
-                                   ("no snapshot with status code 200", cdx_id))
-                    cursor.execute("COMMIT;")
-                    cursor.execute("END;")
-                    continue
-
-                for date, index in first_200_data.items():
-                    _, timestamp, url, _, status_code, _, _ = data[index]
-                    assert status_code == "200"
-
-                    endpoint = APIs['archiveorg'].format(date=timestamp, url=url)
-
-                    with connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PWD) as c2:
-                        with c2.cursor() as cursor2:
-                            cursor2.execute("""SELECT DISTINCT end_url FROM cdx_archive_headers""")
-                            urls = {url for url, in cursor2.fetchall()}
-
-                    if endpoint in urls:
-                        with connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PWD) as c2:
-                            with c2.cursor() as cursor2:
-                                cursor2.execute(
-                                    """SELECT headers, content_hash, status_code FROM cdx_archive_headers WHERE end_url=%s""",
-                                    (endpoint,))
-                                response_headers, content_hash, status_code = cursor2.fetchone()
-
-                                # persist response
-                                cursor2.execute(
-                                    "INSERT INTO cdx_archive_headers (cdx_responses_id, url_date, start_url, end_url, headers, content_hash, status_code) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                                    (cdx_id, date, endpoint, endpoint, json.dumps(response_headers), content_hash,
-                                     status_code))
-                        continue
-
-                    print(f'[W-{worker_id}] querying {endpoint}')
-                    try:
-                        r = SESSION.get(endpoint, timeout=timeout, allow_redirects=True)
-                    except Exception as error:
-                        print(f'[W-{worker_id}] ERROR querying {endpoint}')
-                        cursor.execute("UPDATE cdx_responses SET error=%s WHERE id=%s;",
-                                       (json.dumps(f"{error}"), cdx_id))
-                    else:
-                        print(f'[W-{worker_id}] SUCCESS querying {endpoint}')
-
-                        content = r.content
-                        content_hash = sha256(content).hexdigest()
-                        file_dir = os.path.join(STORAGE, content_hash[0], content_hash[1])
-                        if not os.path.exists(file_dir):
-                            os.makedirs(file_dir)
-                        file_path = os.path.join(file_dir, f"{content_hash}.gz")
-                        with gzip.open(file_path, "wb") as fh:
-                            fh.write(content)
-
-                        response_headers = {h.lower(): r.headers[h] for h in r.headers}
-                        response_headers = json.dumps(response_headers)
-
-                        # persist response
-                        with connect(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PWD) as c2:
-                            with c2.cursor() as insertion:
-                                insertion.execute(
-                                    "INSERT INTO cdx_archive_headers (cdx_responses_id, url_date, start_url, end_url, headers, content_hash, status_code) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                                    (cdx_id, date, endpoint, r.url, response_headers, content_hash, r.status_code))
-
-                cursor.execute("UPDATE cdx_responses SET parsed=TRUE WHERE id=%s;", (cdx_id,))
-
-                cursor.execute("COMMIT;")
-                cursor.execute("END;")
-                sleep(1)
-
-    print(f'Worker {worker_id} terminates!')
+            add_columns(cursor)
+            cursor.execute("CREATE INDEX IF NOT EXISTS cdx_archive_headers_end_url_idx ON cdx_archive_headers (end_url)")
 
 
 def update_cdx():
     print('START cdx update.....')
-    processes = list()
-    for wid in range(8):
-        p = Process(target=worker, args=(wid, 60))
-        processes.append(p)
-        p.start()
-    for p in processes:
-        p.join()
+    ensure_schema()
+    queue = JobQueue("cdx_archive_headers")
+    # Answers collected since the last run are added, the ones that are already queued are skipped
+    queue.enqueue_query("""
+        SELECT id::text, jsonb_build_array(id, content_hash) FROM cdx_responses WHERE NOT parsed AND status_code=200
+    """)
+
+    # Stage 3: rows are written in batches, an answer is marked as parsed (and its job completed) in the transaction
+    # that writes its last row
+    def finish(cur, tags):
+        cur.execute("UPDATE cdx_responses SET parsed=TRUE WHERE id = ANY(%s);", ([cdx_id for _, cdx_id in tags],))
+        queue.complete_many([job_id for job_id, _ in tags], cur)
+
+    # A batch can end in the middle of an answer, after a crash its job runs again and the rows that were already
+    # flushed are skipped (unique index of setup())
+    writer = BatchWriter("INSERT INTO cdx_archive_headers (cdx_responses_id, url_date, start_url, end_url, headers, "
+                         "content_hash, truncated, status_code) VALUES %s "
+                         "ON CONFLICT (cdx_responses_id, url_date) DO NOTHING", on_flush=finish)
+
+    def store(row, cdx_id, values):
+        row["left"] -= 1
+        if values is not None:
+            writer.add(values, (row["job"], cdx_id) if row["left"] == 0 else None)
+        elif row["left"] == 0:
+            # The last snapshot failed, the rows before it are written first
+            writer.flush()
+            with cursor() as cur:
+                finish(cur, [(row["job"], cdx_id)])
+
+    def claim():
+        # A batch that was copied completely does not end the run, only an empty queue does
+        while True:
+            jobs, copies = claim_batch(queue)
+            for row, cdx_id, values in copies:
+                store(row, cdx_id, values)
+            if jobs or not copies:
+                return jobs
+
+    # Stage 2: the snapshots are fetched concurrently, ARCHIVE_CONCURRENCY['cdx'] requests in flight
+    def handle(job, result):
+        row, cdx_id, date = job.data
+        queue.heartbeat()
+        if result.error is not None:
+            print(f'ERROR querying {job.url}')
+            with cursor() as cur:
+                cur.execute("UPDATE cdx_responses SET error=%s WHERE id=%s;", (json.dumps(result.error), cdx_id))
+            store(row, cdx_id, None)
+            return
+        response_headers = header_dict(result.headers, lower=True)
+        store(row, cdx_id, (cdx_id, date, job.url, result.url, json.dumps(response_headers), result.content_hash,
+                            result.truncated, result.status))
+
+    with writer:
+        run([], handle, refill=claim)
+
+    print(f'Content store: {report()}')
+    print(f"Queue: {queue.progress()}")
+    queue.close()
     print('DONE.')
 
 
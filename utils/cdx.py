@@ -0,0 +1,96 @@
+import json
+
+from config import CDX_API, CDX_PAGE_SIZE
+from utils.deadline import Deadline
+from utils.ratelimit import limited_get
+
+# Client for the Wayback CDX API.
+# Only the fields that are used are requested (fl=), large answers are fetched in pages (showResumeKey) and every
+# page is parsed line by line, so neither the transfer nor the memory grow with the fields or pages we do not need.
+# The JSON answer has one row per line:
+#   [["timestamp","original","statuscode"],
+#   ["20221226000512","http://example.com/","200"],
+#   [],
+#   ["<resume key>"]]
+
+FIELDS = ("urlkey", "timestamp", "original", "mimetype", "statuscode", "digest", "length")
+
+
+def parse_lines(lines):
+    """Rows of a CDX JSON answer (or of a stored one), one list per line, without loading the whole answer."""
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if line.startswith("[[") and line.endswith("]]"):
+            # The whole answer in one line
+            yield from json.loads(line)
+            continue
+        if line.startswith("[["):
+            line = line[1:]
+        if line.endswith("]]"):
+            line = line[:-1]
+        line = line.rstrip(",")
+        if not line or line in ("[", "]"):
+            continue
+        yield json.loads(line)
+
+
+def records(lines):
+    """Rows of a CDX JSON answer as dicts keyed by the field names of its header row, old answers with all fields
+    and projected ones are read the same way."""
+    rows = parse_lines(lines)
+    header = next(rows, None)
+    if not header:
+        return
+    for row in rows:
+        if not row:
+            # Resume key
+            break
+        yield dict(zip(header, row))
+
+
+def dump_lines(fields, rows):
+    """The inverse of parse_lines, encodes rows as a CDX JSON answer line by line (e.g. for put_stream)."""
+    yield ("[" + json.dumps(list(fields))).encode("utf-8")
+    for row in rows:
+        yield (",\n" + json.dumps(list(row))).encode("utf-8")
+    yield b"]\n"
+
+
+def query(session, url, fields=FIELDS, collapse=None, filters=(), start=None, end=None, page_size=CDX_PAGE_SIZE,
+          timeout=None):
+    """Yields the snapshots of url as tuples of `fields`, page by page.
+
+    collapse="timestamp:8" keeps one snapshot per day, filters are CDX filters like "statuscode:200", start and end
+    are YYYYMMDD[hhmmss] strings. timeout (seconds) is a hard limit for the whole query, also for answers that trickle
+    in, without it every page gets the default deadline.
+    """
+    params = {"url": url, "output": "json", "fl": ",".join(fields), "showResumeKey": "true", "limit": page_size}
+    if collapse is not None:
+        params["collapse"] = collapse
+    if filters:
+        params["filter"] = list(filters)
+    if start is not None:
+        params["from"] = start
+    if end is not None:
+        params["to"] = end
+
+    deadline = None if timeout is None else Deadline(timeout)
+    while True:
+        page_deadline = deadline or Deadline()
+        resume_key = None
+        with limited_get(session, CDX_API, params=params, stream=True, timeout=page_deadline.timeout()) as res:
+            res.raise_for_status()
+            rows = parse_lines(page_deadline.iterate(res.iter_lines()))
+            if not next(rows, None):
+                return
+            for row in rows:
+                if not row:
+                    resume = next(rows, None)
+                    resume_key = resume[0] if resume else None
+                    break
+                yield tuple(row)
+        if resume_key is None:
+            return
+        params["resumeKey"] = resume_key
@@ -0,0 +1,142 @@
+import hashlib
+import os
+import threading
+from datetime import datetime, timedelta
+
+import numpy
+import requests
+
+from config import CDX_INDEX
+from utils.cdx import query
+
+# Local copy of the Wayback CDX index, one compressed numpy file per URL.
+# Every file keeps the snapshots sorted by time in columns (time, timestamp, original, status) together with the
+# day ranges that were already fetched, so a query only goes to the network for days it has not seen yet and the
+# nearest snapshot and its neighbours are found with a bisection.
+
+COLUMNS = {"time": "datetime64[s]", "timestamp": "U14", "original": "U", "status": "U"}
+DAY = timedelta(days=1)
+
+
+def empty():
+    entry = {name: numpy.array([], dtype=dtype) for name, dtype in COLUMNS.items()}
+    entry["covered"] = numpy.zeros((0, 2), dtype="datetime64[D]")
+    return entry
+
+
+def fetch_range(url, start, end, session=requests):
+    """Snapshots of url between the days start and end (both included) from the CDX API, as (timestamp, original,
+    status) tuples."""
+    return list(query(session, url, fields=("timestamp", "original", "statuscode"),
+                      start=f"{start:%Y%m%d}", end=f"{end:%Y%m%d}"))
+
+
+def missing(covered, start, end):
+    """The parts of the day range [start, end] that are not in the (sorted, disjoint) covered ranges."""
+    gaps = []
+    for lo, hi in covered.astype(object):
+        if hi < start:
+            continue
+        if lo > end:
+            break
+        if lo > start:
+            gaps.append((start, lo - DAY))
+        start = max(start, hi + DAY)
+        if start > end:
+            return gaps
+    gaps.append((start, end))
+    return gaps
+
+
+def merge(covered, start, end):
+    ranges = sorted([tuple(r) for r in covered.astype(object)] + [(start, end)])
+    merged = [list(ranges[0])]
+    for lo, hi in ranges[1:]:
+        if lo <= merged[-1][1] + DAY:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    return numpy.array(merged, dtype="datetime64[D]")
+
+
+class CdxIndex:
+    def __init__(self, root=CDX_INDEX, fetch=fetch_range):
+        self.root = root
+        self.fetch = fetch
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+
+    def path(self, url):
+        h = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.root, h[:2], f"{h}.npz")
+
+    def lock(self, url):
+        with self.locks_lock:
+            return self.locks.setdefault(url, threading.Lock())
+
+    def load(self, url):
+        try:
+            with numpy.load(self.path(url), allow_pickle=False) as data:
+                return {name: data[name] for name in list(COLUMNS) + ["covered"]}
+        except FileNotFoundError:
+            return empty()
+
+    def save(self, url, entry):
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written next to the file and renamed, readers in other processes never see a partial index
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        numpy.savez_compressed(tmp, **entry)
+        os.replace(tmp, path)
+
+    def ensure(self, url, start, end):
+        """Loads the index of url and fetches the days between start and end it does not cover yet."""
+        with self.lock(url):
+            entry = self.load(url)
+            # Days after today have no snapshots yet, they are neither fetched nor marked as covered
+            today = datetime.now().date()
+            gaps = [(lo, min(hi, today)) for lo, hi in missing(entry["covered"], start, end) if lo <= today]
+            if not gaps:
+                return entry
+            rows = []
+            for lo, hi in gaps:
+                rows += self.fetch(url, lo, hi)
+            if rows:
+                timestamps = numpy.array([row[0] for row in rows], dtype="U14")
+                new = {
+                    "time": numpy.array([datetime.strptime(t, "%Y%m%d%H%M%S") for t in timestamps],
+                                        dtype="datetime64[s]"),
+                    "timestamp": timestamps,
+                    "original": numpy.array([row[1] for row in rows], dtype="U"),
+                    "status": numpy.array([row[2] for row in rows], dtype="U"),
+                }
+                # Snapshots with the same timestamp are listed once, like the dict of the old parser did
+                combined = {name: numpy.concatenate([entry[name], new[name]]) for name in COLUMNS}
+                _, first = numpy.unique(combined["time"], return_index=True)
+                entry.update({name: combined[name][first] for name in COLUMNS})
+            for lo, hi in gaps:
+                entry["covered"] = merge(entry["covered"], lo, hi)
+            self.save(url, entry)
+            return entry
+
+    def nearest(self, url, date, ticks=25, days=30, max_days=2000):
+        """The snapshots closest to date with `ticks` neighbours on each side, as (time, timestamp, original, status)
+        rows, growing the window around date (x4) until there are enough. None if there are no snapshots close to
+        date, [] if there are not enough neighbours within max_days."""
+        target = numpy.datetime64(date, "s")
+        while days < max_days:
+            start, end = date.date() - timedelta(days=days), date.date() + timedelta(days=days)
+            entry = self.ensure(url, start, end)
+            times = entry["time"]
+            lo, hi = numpy.searchsorted(times, numpy.array([start, end + DAY], dtype="datetime64[s]"))
+            if lo == hi:
+                return None
+            i = lo + numpy.searchsorted(times[lo:hi], target)
+            if i == hi or (i > lo and target - times[i - 1] <= times[i] - target):
+                i -= 1
+            if i - ticks >= lo and i + ticks < hi:
+                return [(times[j].astype(object), str(entry["timestamp"][j]), str(entry["original"][j]),
+                         str(entry["status"][j]))
+                        for j in range(i - ticks, i + ticks + 1)]
+            days *= 4
+        return []
@@ -1,7 +1,147 @@
-from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PWD
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from config import DB_HOST, DB_PORT, DB_NAME, DB_USER, DB_PWD, DB_POOL_MIN, DB_POOL_MAX, DB_BATCH_SIZE, \
+    DB_BATCH_INTERVAL
 import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 
 def get_conn(autocommit=False):
     conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PWD, database=DB_NAME)
     conn.autocommit = autocommit
     return conn
+
+
+pools = {}
+pool_slots = {}
+pools_lock = threading.Lock()
+
+
+def get_pool():
+    # One pool per process, connections must not be shared with forked pool workers
+    with pools_lock:
+        if os.getpid() not in pools:
+            pools[os.getpid()] = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, host=DB_HOST, port=DB_PORT,
+                                                        user=DB_USER, password=DB_PWD, database=DB_NAME)
+            # getconn raises PoolError when all connections are out, callers wait for a free one instead
+            pool_slots[os.getpid()] = threading.BoundedSemaphore(DB_POOL_MAX)
+        return pools[os.getpid()]
+
+
+@contextmanager
+def connection(autocommit=False):
+    """Borrows a pooled connection, commits on success and rolls back on errors.
+
+    Waits while all DB_POOL_MAX connections are borrowed, e.g. by THREADS workers.
+    """
+    pool = get_pool()
+    with pool_slots[os.getpid()]:
+        conn = pool.getconn()
+        conn.autocommit = autocommit
+        try:
+            yield conn
+            if not autocommit:
+                conn.commit()
+        except BaseException:
+            if not autocommit:
+                conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn)
+
+
+@contextmanager
+def cursor(autocommit=False):
+    with connection(autocommit) as conn:
+        with conn.cursor() as cur:
+            yield cur
+
+
+class CopyStream:
+    """File-like object that feeds rows to COPY ... FROM STDIN without building the whole input in memory."""
+
+    def __init__(self, rows):
+        self.lines = (copy_line(row) for row in rows)
+        self.buffer = ""
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_line(row):
+    return "\t".join(copy_value(value) for value in row) + "\n"
+
+
+def copy_rows(cur, table, columns, rows):
+    """Loads an iterable of rows into table with COPY, much faster than INSERTs for large inputs."""
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", CopyStream(rows))
+    return cur.rowcount
+
+
+class BatchWriter:
+    """Buffers the rows of one `INSERT ... VALUES %s` statement and writes them with a single transaction per batch.
+
+    Every row can carry a tag, on_flush(cursor, tags) runs in the same transaction (e.g. to complete the jobs the
+    rows belong to), so rows and their bookkeeping are committed together.
+    """
+
+    def __init__(self, query, batch_size=DB_BATCH_SIZE, interval=DB_BATCH_INTERVAL, on_flush=None):
+        self.query = query
+        self.batch_size = batch_size
+        self.interval = interval
+        self.on_flush = on_flush
+        self.rows = []
+        self.tags = []
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, row, tag=None):
+        with self.lock:
+            self.rows.append(row)
+            if tag is not None:
+                self.tags.append(tag)
+            due = len(self.rows) >= self.batch_size or time.time() - self.last_flush >= self.interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            rows, tags = self.rows, self.tags
+            self.rows, self.tags = [], []
+            self.last_flush = time.time()
+        if not rows:
+            return
+        try:
+            with cursor() as cur:
+                execute_values(cur, self.query, rows, page_size=len(rows))
+                if self.on_flush is not None:
+                    self.on_flush(cur, tags)
+        except BaseException:
+            # The transaction was rolled back, the rows are written with the next flush
+            with self.lock:
+                self.rows[:0] = rows
+                self.tags[:0] = tags
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
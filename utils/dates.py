@@ -0,0 +1,93 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from config import SNAPSHOT_WINDOW_DAYS
+
+# The quarterly dates all collectors take snapshots for.
+# A DateGrid parses its dates once and answers "which target is closest to this snapshot" with a bisection instead
+# of comparing against (and parsing) every target, the *_many variants do the same for whole numpy arrays.
+
+DATES = ["20160115", "20160415", "20160715", "20161015",
+         "20170115", "20170415", "20170715", "20171015",
+         "20180115", "20180415", "20180715", "20181015",
+         "20190115", "20190415", "20190715", "20191015",
+         "20200115", "20200415", "20200715", "20201015",
+         "20210115", "20210415", "20210715", "20211015",
+         "20220115", "20220415", "20220715"]
+
+# Snapshots further away from their target date are invalid (see updater.set_valid)
+WINDOW = timedelta(days=SNAPSHOT_WINDOW_DAYS)
+
+
+class DateGrid:
+    def __init__(self, dates=DATES, window=WINDOW):
+        self.dates = sorted(dates)
+        self.targets = [datetime.strptime(date, "%Y%m%d") for date in self.dates]
+        self.window = window
+        self.years = sorted({target.year for target in self.targets})
+        self._targets64 = None
+
+    def nearest_index(self, date):
+        """Index of the target closest to date, ties go to the earlier target."""
+        i = bisect_left(self.targets, date)
+        if i == 0:
+            return 0
+        if i == len(self.targets):
+            return i - 1
+        return i - 1 if date - self.targets[i - 1] <= self.targets[i] - date else i
+
+    def nearest(self, date):
+        return self.targets[self.nearest_index(date)]
+
+    def in_window(self, date, target):
+        return abs(date - target) <= self.window
+
+    def nearest_in_window(self, date):
+        """The closest target if date is within the window around it, else None."""
+        target = self.nearest(date)
+        return target if self.in_window(date, target) else None
+
+    def within(self, date):
+        """Indices of all targets whose window contains date."""
+        return range(bisect_left(self.targets, date - self.window), bisect_right(self.targets, date + self.window))
+
+    @property
+    def targets64(self):
+        if numpy is None:
+            raise RuntimeError("The vectorized date functions need numpy")
+        if self._targets64 is None:
+            self._targets64 = numpy.array(self.targets, dtype="datetime64[us]")
+        return self._targets64
+
+    def nearest_many(self, dates):
+        """nearest_index for an array of datetime64 (or anything numpy converts to it), returns an index array."""
+        targets = self.targets64
+        dates = numpy.asarray(dates, dtype="datetime64[us]")
+        if len(targets) == 1:
+            return numpy.zeros(dates.shape, dtype=int)
+        right = numpy.clip(numpy.searchsorted(targets, dates), 1, len(targets) - 1)
+        left = right - 1
+        return numpy.where(dates - targets[left] <= targets[right] - dates, left, right)
+
+    def in_window_many(self, dates, indices=None):
+        """Mask of the dates within the window around their nearest target (or the targets at indices)."""
+        dates = numpy.asarray(dates, dtype="datetime64[us]")
+        if indices is None:
+            indices = self.nearest_many(dates)
+        return numpy.abs(dates - self.targets64[indices]) <= numpy.timedelta64(self.window)
+
+
+GRID = DateGrid()
+
+
+def nearest(date):
+    return GRID.nearest(date)
+
+
+def nearest_in_window(date):
+    return GRID.nearest_in_window(date)
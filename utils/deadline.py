@@ -0,0 +1,52 @@
+import asyncio
+import time
+
+from config import FETCH_DEADLINE, FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT
+
+# Deadlines replace the old SIGALRM based timeout() context managers.
+# signal.alarm only works in the main thread, a Deadline works the same in threads, processes and asyncio:
+# every socket operation gets min(connect/read timeout, remaining time) and the total is checked between chunks.
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    def __init__(self, total=FETCH_DEADLINE, connect=FETCH_CONNECT_TIMEOUT, read=FETCH_READ_TIMEOUT):
+        self.total = total
+        self.connect = connect
+        self.read = read
+        self.end = time.monotonic() + total
+
+    def remaining(self):
+        return max(0.0, self.end - time.monotonic())
+
+    def expired(self):
+        return self.remaining() == 0
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded(f"Hard kill due to timeout! ({self.total}s)")
+
+    def timeout(self):
+        # (connect, read) tuple for `requests`
+        self.check()
+        remaining = self.remaining()
+        return min(self.connect, remaining), min(self.read, remaining)
+
+    def iterate(self, chunks):
+        # Stops a body that trickles in slower than the deadline allows, even if every single read is fast enough
+        for chunk in chunks:
+            self.check()
+            yield chunk
+
+    async def wait(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.remaining())
+        except asyncio.TimeoutError:
+            # Socket timeouts (e.g. aiohttp.ServerTimeoutError) are TimeoutErrors as well, they stay what they are
+            if not self.expired():
+                raise
+            raise DeadlineExceeded(f"Hard kill due to timeout! ({self.total}s)") from None
+
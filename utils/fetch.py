@@ -0,0 +1,282 @@
+import asyncio
+import signal
+import time
+import traceback
+from collections import namedtuple, defaultdict, deque, Counter
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from config import USER_AGENT, FETCH_CONCURRENCY, FETCH_HOST_CONCURRENCY, ARCHIVE_CONCURRENCY, FETCH_DEADLINE, \
+    FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT, MAX_BODY_SIZE, STREAM_CHUNK_SIZE, RATE_RETRIES
+from utils.deadline import Deadline, DeadlineExceeded
+from utils.ratelimit import get_limiter, THROTTLED, report
+from utils.scheduler import Throughput
+from utils.redirects import REDIRECT_SCAN_BYTES, is_redirect_page, check_redirect
+from utils.storage import get_store
+
+# One asyncio event loop fetches for all workers of a collector.
+# Jobs are grouped by key (the archive, or the host for live crawls) and every key gets its own concurrency limit,
+# all keys together share one connection pool and a global limit.
+# Requests are paced by the token bucket of their host (see utils.ratelimit), throttled jobs are queued again.
+
+# key: concurrency limit and pacing group, defaults to the host of url
+# archive: follow archive specific redirect pages (see utils.redirects)
+# dict_key: zstd dictionary used to store the body
+# data: passed through untouched to the result handler
+Job = namedtuple("Job", ["url", "key", "archive", "dict_key", "data"], defaults=[None, None, None, None])
+
+# duration: ns until the response headers arrived, runtime: s until the body was stored
+# redirect: the last archive redirect page that was followed, if any
+# body: the body itself for in_memory runs, content_hash is None then
+FetchResult = namedtuple("FetchResult", ["url", "status", "headers", "content_hash", "length", "truncated",
+                                         "duration", "runtime", "redirect", "error", "traceback", "body"],
+                         defaults=[None])
+
+
+class Stopped(KeyboardInterrupt):
+    """Raised by a graceful run after SIGINT, jobs holds the jobs that were taken from refill() but not handled."""
+
+    def __init__(self, jobs):
+        super().__init__(f"Stopped with {len(jobs)} jobs left")
+        self.jobs = jobs
+
+
+def header_dict(headers, lower=False):
+    # Repeated headers are joined like `requests` does, so rows look the same as before
+    result = {}
+    for name, value in headers.items():
+        if lower:
+            name = name.lower()
+        result[name] = f"{result[name]}, {value}" if name in result else value
+    return result
+
+
+def job_key(job):
+    return job.key if job.key is not None else urlsplit(job.url).hostname
+
+
+async def store_body(response, dict_key=None, body=None, max_size=MAX_BODY_SIZE):
+    store = get_store()
+    writer = store.writer(max_size, dict_key)
+    loop = asyncio.get_running_loop()
+    write = None
+    try:
+        # body is the part that was already read to look for a redirect page, the rest is streamed
+        if body is None or writer.write(body):
+            async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                # zlib releases the GIL, compressing off the loop keeps the other fetches going
+                write = loop.run_in_executor(None, writer.write, chunk)
+                if not await asyncio.shield(write):
+                    break
+    except BaseException:
+        # A cancelled or timed out fetch leaves its last write running in the executor, the stream must not be
+        # closed under it
+        if write is not None and not write.done():
+            await asyncio.wait([write])
+        writer.abort()
+        raise
+    # fsync, pack append and index insert, none of them may hold up the other fetches
+    content_hash = await loop.run_in_executor(None, writer.commit)
+    return content_hash, writer.length, writer.truncated
+
+
+async def read_head(response, size):
+    # Up to size bytes of the body, StreamReader.read returns whatever is buffered
+    head = b""
+    while len(head) < size:
+        chunk = await response.content.read(size - len(head))
+        if not chunk:
+            break
+        head += chunk
+    return head
+
+
+async def read_body(response, body=None, max_size=MAX_BODY_SIZE):
+    # Bodies that are parsed once and thrown away (e.g. TimeMaps) stay out of the content store
+    if max_size is None:
+        rest = await response.content.read()
+    else:
+        # One byte more than fits tells a truncated body from one of exactly max_size bytes
+        rest = await read_head(response, max_size + 1 - len(body or b""))
+    body = (body or b"") + rest
+    truncated = max_size is not None and len(body) > max_size
+    if truncated:
+        body = body[:max_size]
+    return body, len(body), truncated
+
+
+async def fetch(session, job, max_size=MAX_BODY_SIZE, paced=True, in_memory=False):
+    start = time.time()
+    start_ns = time.time_ns()
+    response = await session.get(job.url, allow_redirects=True)
+    duration = time.time_ns() - start_ns
+    if paced:
+        get_limiter(job.url).update(response.status, response.headers)
+    redirect = None
+    body = None
+    try:
+        for _ in range(3):
+            if job.archive is None or not is_redirect_page(response.headers):
+                break
+            # Redirect pages are small, only the part that is scanned for the link is read into memory
+            body = await read_head(response, REDIRECT_SCAN_BYTES if max_size is None
+                                   else min(REDIRECT_SCAN_BYTES, max_size))
+            redirect_url = check_redirect(job.archive, body)
+            if not redirect_url:
+                break
+            response.release()
+            limiter = get_limiter(redirect_url)
+            await limiter.acquire_async()
+            response = await session.get(redirect_url, allow_redirects=True)
+            limiter.update(response.status, response.headers)
+            redirect = redirect_url
+            body = None
+        if in_memory:
+            content_hash = None
+            body, length, truncated = await read_body(response, body, max_size)
+        else:
+            content_hash, length, truncated = await store_body(response, job.dict_key, body, max_size)
+            body = None
+    finally:
+        response.release()
+    return FetchResult(str(response.url), response.status, response.headers, content_hash, length, truncated,
+                       duration, time.time() - start, redirect, None, None, body)
+
+
+async def fetch_or_error(session, job, deadline, max_size=MAX_BODY_SIZE, paced=True, in_memory=False):
+    start = time.time()
+    try:
+        return await Deadline(deadline).wait(fetch(session, job, max_size, paced, in_memory))
+    except aiohttp.ServerTimeoutError as exp:
+        error, trace = str(exp) or 'Timeout while connecting or reading', traceback.format_exc()
+    except DeadlineExceeded as exp:
+        error, trace = str(exp), traceback.format_exc()
+    except Exception as exp:
+        error, trace = str(exp) or type(exp).__name__, traceback.format_exc()
+    return FetchResult(job.url, -1, None, None, None, False, None, time.time() - start, None, error, trace)
+
+
+async def run_async(jobs, handle, concurrency=FETCH_CONCURRENCY, deadline=FETCH_DEADLINE, max_size=MAX_BODY_SIZE,
+                    retries=RATE_RETRIES, refill=None, throughput=None, paced=True, graceful=False,
+                    in_memory=False):
+    queues = defaultdict(deque)
+    running = Counter()
+    tasks = set()
+    in_flight = {}
+    exhausted = refill is None
+    stopping = aborted = False
+
+    limit = asyncio.Semaphore(concurrency)
+    attempts = Counter()
+    timeout = aiohttp.ClientTimeout(sock_connect=FETCH_CONNECT_TIMEOUT, sock_read=FETCH_READ_TIMEOUT)
+    # Per host limits are enforced by the workers of each key, the connector only caps the total
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=0, ttl_dns_cache=300)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                     headers={"User-Agent": USER_AGENT}) as session:
+        def add(new_jobs):
+            for job in new_jobs:
+                queues[job_key(job)].append(job)
+            for key, queue in queues.items():
+                while running[key] < min(len(queue), ARCHIVE_CONCURRENCY.get(key, FETCH_HOST_CONCURRENCY)):
+                    running[key] += 1
+                    task = asyncio.create_task(worker(key))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+        def more():
+            # Claims the next batch once the local queue of a key ran dry (see utils.jobs). Only while fewer than
+            # `concurrency` jobs wait, else the queues of slow keys grow with every batch the fast keys claim and
+            # their jobs sit leased for hours
+            nonlocal exhausted
+            if exhausted or stopping or sum(map(len, queues.values())) >= concurrency:
+                return False
+            new_jobs = refill()
+            if not new_jobs:
+                exhausted = True
+                return False
+            add(new_jobs)
+            return True
+
+        async def worker(key):
+            queue = queues[key]
+            try:
+                while not stopping and (queue or more()):
+                    if not queue:
+                        # The new batch only had jobs for other keys, their workers take over
+                        break
+                    job = queue.popleft()
+                    in_flight[id(job)] = job
+                    # Waiting for a token does not count towards the deadline and does not hold a connection slot
+                    if paced:
+                        await get_limiter(job.url).acquire_async()
+                    if stopping:
+                        queue.appendleft(job)
+                        in_flight.pop(id(job), None)
+                        break
+                    async with limit:
+                        result = await fetch_or_error(session, job, deadline, max_size, paced, in_memory)
+                    if paced and result.status in THROTTLED and attempts[id(job)] < retries:
+                        attempts[id(job)] += 1
+                        queue.append(job)
+                        in_flight.pop(id(job), None)
+                        continue
+                    attempts.pop(id(job), None)
+                    handle(job, result)
+                    in_flight.pop(id(job), None)
+                    if throughput is not None:
+                        throughput.add(key, result.runtime)
+                    # Keys that stopped at the limit of more() get new jobs once the others worked theirs off
+                    more()
+            finally:
+                running[key] -= 1
+
+        def interrupt():
+            # First Ctrl-C: no new requests, the ones in flight are still stored. Second Ctrl-C: cancel them too
+            nonlocal stopping, aborted
+            if stopping:
+                aborted = True
+                for task in list(tasks):
+                    task.cancel()
+                return
+            stopping = True
+            print(f"Draining {len(in_flight)} requests in flight, press Ctrl-C again to abort")
+
+        loop = asyncio.get_running_loop()
+        if graceful:
+            loop.add_signal_handler(signal.SIGINT, interrupt)
+        try:
+            add(jobs)
+            if not tasks:
+                more()
+            while tasks:
+                try:
+                    await asyncio.gather(*list(tasks))
+                except asyncio.CancelledError:
+                    if not aborted:
+                        raise
+        finally:
+            if graceful:
+                loop.remove_signal_handler(signal.SIGINT)
+        if stopping:
+            # Jobs that were taken from refill() but not handled, so the caller can give them back
+            raise Stopped(list(in_flight.values()) + [job for queue in queues.values() for job in queue])
+
+
+def run(jobs, handle, **kwargs):
+    """Fetch all jobs and call handle(job, result) for each of them as soon as its body is stored.
+
+    refill() is called whenever a key ran out of jobs and returns the next jobs, an empty list ends the run.
+    paced=False skips the rate limiters, for crawls that hit every host only once.
+    in_memory=True hands the body (up to max_size) to handle as result.body instead of storing it.
+    graceful=True stops at the first SIGINT once the requests in flight are handled and raises Stopped with the jobs
+    that were not handled, e.g. to release them in the job queue.
+    """
+    # Workers of one key share a deque and take the next job as soon as they are free, so the report is per key
+    throughput = Throughput("fetch")
+    try:
+        asyncio.run(run_async(jobs, handle, throughput=throughput, **kwargs))
+    finally:
+        print(throughput.report())
+        print(f"Rate limits: {report()}")
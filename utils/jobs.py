@@ -0,0 +1,228 @@
+import os
+import socket
+import threading
+import time
+
+from psycopg2.extras import Json, execute_values
+
+from config import JOB_BATCH, JOB_LEASE, JOB_MAX_ATTEMPTS
+from utils.database import get_conn
+
+# Work queue shared by all collectors.
+# Every collector adds its new work on every run under its own queue name, workers on any number of machines claim
+# leased batches with FOR UPDATE SKIP LOCKED. A lease that is not extended by heartbeat() runs out and the job is
+# handed to the next worker, failed jobs go back to pending until they reach max_attempts.
+
+TABLE_NAME = "job_queue"
+
+
+def setup(conn=None):
+    conn = conn or get_conn(True)
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {TABLE_NAME} (
+                id BIGSERIAL PRIMARY KEY,
+                queue VARCHAR(128) NOT NULL,
+                key TEXT NOT NULL,
+                payload JSONB,
+                status VARCHAR(8) DEFAULT 'pending',
+                attempts INT DEFAULT 0,
+                leased_by VARCHAR(128) DEFAULT NULL,
+                lease_until TIMESTAMP DEFAULT NULL,
+                error TEXT DEFAULT NULL,
+                updated TIMESTAMP DEFAULT NOW(),
+                priority INT DEFAULT 0,
+                UNIQUE (queue, key)
+            );
+        """)
+        # Queues created before jobs had a priority
+        cursor.execute(f"ALTER TABLE {TABLE_NAME} ADD COLUMN IF NOT EXISTS priority INT DEFAULT 0")
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS {TABLE_NAME}_claim ON {TABLE_NAME} (queue, status, lease_until, id)
+        """)
+        cursor.execute(f"""
+            CREATE INDEX IF NOT EXISTS {TABLE_NAME}_priority ON {TABLE_NAME} (queue, status, priority, id)
+        """)
+
+
+class JobQueue:
+    def __init__(self, name, lease=JOB_LEASE, max_attempts=JOB_MAX_ATTEMPTS, conn=None):
+        self.name = name
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.conn = conn or get_conn(True)
+        self.worker = f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+        self.leased = set()
+        self.last_heartbeat = time.time()
+        setup(self.conn)
+
+    def enqueue(self, items):
+        """Adds (key, payload) pairs, keys that are already queued (in any state) are skipped."""
+        return self._insert(items)[0]
+
+    def _insert(self, items, done_query=None):
+        # (added, added as done), of the keys added those returned by done_query are marked done right away
+        with self.conn.cursor() as cursor:
+            rows = [(self.name, key, Json(payload)) for key, payload in items]
+            added = execute_values(cursor, f"""
+                INSERT INTO {TABLE_NAME} (queue, key, payload) VALUES %s ON CONFLICT (queue, key) DO NOTHING
+                RETURNING id
+            """, rows, page_size=1000, fetch=True)
+            done = 0
+            if done_query is not None and added:
+                cursor.execute(f"""
+                    UPDATE {TABLE_NAME} SET status = 'done', updated = NOW()
+                    WHERE id = ANY(%s) AND key IN ({done_query})
+                """, ([job_id for job_id, in added],))
+                done = cursor.rowcount
+            return len(added), done
+
+    def enqueue_query(self, query, params=None, prioritized=False):
+        """Enqueues the (key, payload) rows of a query without sending them through the client.
+
+        With prioritized=True the query returns (key, payload, priority) rows, jobs with a lower priority are claimed
+        first.
+        """
+        return self._insert_query(query, params, prioritized)[0]
+
+    def _insert_query(self, query, params=None, prioritized=False, done_query=None):
+        # Like _insert, keys that are added and returned by done_query are queued as done
+        columns = "key, payload, priority" if prioritized else "key, payload"
+        status = "'pending'" if done_query is None else f"CASE WHEN q.key IN ({done_query}) THEN 'done' ELSE 'pending' END"
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"""
+                WITH added AS (
+                    INSERT INTO {TABLE_NAME} (queue, {columns}, status)
+                    SELECT %s, q.*, {status} FROM ({query}) AS q ({columns})
+                    ON CONFLICT (queue, key) DO NOTHING
+                    RETURNING status
+                )
+                SELECT count(*), count(*) FILTER (WHERE status = 'done') FROM added
+            """, (self.name,) + tuple(params or ()))
+            return cursor.fetchone()
+
+    def seed(self, items, done_query=None, params=None, prioritized=False):
+        """Adds the (key, payload) pairs or the rows of a query that are not queued yet, on every run, so changes of
+        the input are picked up. Keys returned by done_query (e.g. rows stored before the queue existed) are marked
+        done when they are added, keys that are already queued keep their state. Returns the number of added jobs."""
+        if isinstance(items, str):
+            added, done = self._insert_query(items, params, prioritized, done_query)
+        else:
+            added, done = self._insert(items, done_query)
+        print(f"{self.name}: {added} jobs added, {done} of them already done")
+        return added
+
+    def claim(self, n=JOB_BATCH):
+        """Leases up to n pending jobs (or jobs whose lease ran out) by priority, returns [(id, key, payload)]."""
+        with self.conn.cursor() as cursor:
+            # A worker that died on the last attempt of a job leaves a lease nobody may claim again, the job failed
+            cursor.execute(f"""
+                UPDATE {TABLE_NAME} SET status = 'failed', error = COALESCE(error, 'Lease expired on the last attempt'),
+                    updated = NOW()
+                WHERE queue = %s AND status = 'leased' AND lease_until < NOW() AND attempts >= %s
+            """, (self.name, self.max_attempts))
+            cursor.execute(f"""
+                UPDATE {TABLE_NAME} SET status = 'leased', leased_by = %s, attempts = attempts + 1,
+                    lease_until = NOW() + %s * INTERVAL '1 second', updated = NOW()
+                WHERE id IN (
+                    SELECT id FROM {TABLE_NAME}
+                    WHERE queue = %s AND (status = 'pending'
+                                          OR (status = 'leased' AND lease_until < NOW() AND attempts < %s))
+                    ORDER BY priority, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING priority, id, key, payload
+            """, (self.worker, self.lease, self.name, self.max_attempts, n))
+            jobs = [(job_id, key, payload) for _, job_id, key, payload in sorted(cursor.fetchall())]
+        self.leased.update(job_id for job_id, _, _ in jobs)
+        self.last_heartbeat = time.time()
+        return jobs
+
+    def heartbeat(self, force=False):
+        # Extends all leases of this worker, cheap enough to be called after every job
+        if not self.leased or (not force and time.time() - self.last_heartbeat < self.lease / 3):
+            return
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {TABLE_NAME} SET lease_until = NOW() + %s * INTERVAL '1 second'
+                WHERE id = ANY(%s) AND leased_by = %s AND status = 'leased'
+            """, (self.lease, list(self.leased), self.worker))
+        self.last_heartbeat = time.time()
+
+    def complete(self, job_id):
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"UPDATE {TABLE_NAME} SET status = 'done', error = NULL, updated = NOW() WHERE id = %s",
+                           (job_id,))
+        self.leased.discard(job_id)
+        self.heartbeat()
+
+    def complete_many(self, job_ids, cursor=None):
+        # With the cursor of a BatchWriter flush the jobs are completed in the same transaction as their rows
+        if cursor is None:
+            with self.conn.cursor() as cursor:
+                return self.complete_many(job_ids, cursor)
+        cursor.execute(f"UPDATE {TABLE_NAME} SET status = 'done', error = NULL, updated = NOW() WHERE id = ANY(%s)",
+                       (list(job_ids),))
+        self.leased.difference_update(job_ids)
+
+    def fail(self, job_id, error):
+        """Returns True if the job goes back to the queue, False once it used up its attempts."""
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {TABLE_NAME}
+                SET status = CASE WHEN attempts < %s THEN 'pending' ELSE 'failed' END, error = %s, updated = NOW()
+                WHERE id = %s
+                RETURNING status
+            """, (self.max_attempts, error, job_id))
+            status, = cursor.fetchone()
+        self.leased.discard(job_id)
+        self.heartbeat()
+        return status == 'pending'
+
+    def release(self, job_ids):
+        """Hands leased jobs that were never started back to the queue without counting the attempt."""
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {TABLE_NAME}
+                SET status = 'pending', attempts = GREATEST(attempts - 1, 0), leased_by = NULL, lease_until = NULL,
+                    updated = NOW()
+                WHERE id = ANY(%s) AND leased_by = %s AND status = 'leased'
+            """, (list(job_ids), self.worker))
+            count = cursor.rowcount
+        self.leased.difference_update(job_ids)
+        return count
+
+    def retry_failed(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"""
+                UPDATE {TABLE_NAME} SET status = 'pending', attempts = 0, updated = NOW()
+                WHERE queue = %s AND status = 'failed'
+            """, (self.name,))
+            return cursor.rowcount
+
+    def progress(self):
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"SELECT status, count(*) FROM {TABLE_NAME} WHERE queue = %s GROUP BY status",
+                           (self.name,))
+            return dict(cursor.fetchall())
+
+    def remaining(self, field=0):
+        """Jobs that are not done yet grouped by payload[field] (e.g. the archive), for progress reports."""
+        with self.conn.cursor() as cursor:
+            cursor.execute(f"""
+                SELECT payload ->> %s, count(*) FROM {TABLE_NAME}
+                WHERE queue = %s AND status IN ('pending', 'leased') GROUP BY 1
+            """, (field, self.name))
+            return dict(cursor.fetchall())
+
+    def drain(self, n=JOB_BATCH):
+        """Yields claimed batches until the queue is empty."""
+        while True:
+            jobs = self.claim(n)
+            if not jobs:
+                break
+            yield jobs
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,58 @@
+import re
+from bisect import bisect_left
+from collections import defaultdict
+from email.utils import parsedate_to_datetime
+
+from utils.dates import WINDOW
+
+# Memento (RFC 7089) TimeMaps list every snapshot of a URL in one document:
+#   <http://web.archive.org/web/20160115093512/http://example.com/>; rel="memento"; datetime="Fri, 15 Jan 2016 ...",
+# Resolving the dates against it locally replaces one request per (archive, date) by one request per archive.
+
+LINK = re.compile(r'<([^>]*)>\s*;([^<]*)')
+REL = re.compile(r'rel\s*=\s*"([^"]*)"')
+DATETIME = re.compile(r'datetime\s*=\s*"([^"]*)"')
+
+
+def parse_timemap(text):
+    """Returns the (datetime, uri) of all mementos of a link format TimeMap, sorted by datetime."""
+    mementos = []
+    for uri, params in LINK.findall(text):
+        rel = REL.search(params)
+        if rel is None or "memento" not in rel.group(1).split():
+            continue
+        date = DATETIME.search(params)
+        if date is None:
+            continue
+        try:
+            mementos.append((parsedate_to_datetime(date.group(1)).replace(tzinfo=None), uri))
+        except (TypeError, ValueError):
+            continue
+    mementos.sort()
+    return mementos
+
+
+def nearest(mementos, date):
+    """The memento closest to date, mementos as returned by parse_timemap."""
+    if not mementos:
+        return None
+    i = bisect_left(mementos, (date,))
+    candidates = mementos[max(i - 1, 0):i + 1]
+    return min(candidates, key=lambda memento: abs(memento[0] - date))
+
+
+def resolve(mementos, dates, window=WINDOW):
+    """Maps the nearest memento datetime of every date to the dates it serves.
+
+    Dates without a memento within the window (see updater.set_valid) are returned separately, they would only
+    produce snapshots that are marked invalid later on.
+    """
+    resolved = defaultdict(list)
+    missing = []
+    for date in dates:
+        memento = nearest(mementos, date)
+        if memento is None or abs(memento[0] - date) > window:
+            missing.append(date)
+        else:
+            resolved[memento[0]].append(date)
+    return resolved, missing
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+from config import RATE_LIMIT, RATE_LIMITS, RATE_MIN, RATE_MAX, RATE_BURST, RATE_INCREASE, RATE_DECREASE, \
+    RATE_DECREASE_WINDOW, RATE_MAX_BACKOFF, RATE_RETRIES
+
+# Token bucket per archive host with AIMD feedback:
+# every answer that is not throttled adds RATE_INCREASE requests/s, a 429/503 multiplies the rate by RATE_DECREASE
+# (once per RATE_DECREASE_WINDOW, a burst of concurrent 429s is one decrease) and a Retry-After header blocks the host
+# until it has passed.
+# Buckets are per process, collectors running several processes share RATE_LIMITS between them.
+
+THROTTLED = (429, 503)
+
+
+def retry_after(headers):
+    # Retry-After is either a number of seconds or an HTTP date
+    if headers is None:
+        return None
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0), RATE_MAX_BACKOFF)
+
+
+class TokenBucket:
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, min_rate=RATE_MIN, max_rate=RATE_MAX):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.blocked_until = 0
+        self.last_decrease = float("-inf")
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        # Takes a token (the balance may go negative) and returns how long the caller has to wait for it
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            return max(wait, self.blocked_until - now)
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def update(self, status, headers=None):
+        """Adjusts the rate to an answer, returns True if the request was throttled and should be repeated."""
+        with self.lock:
+            if status not in THROTTLED:
+                self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+                return False
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self.last_decrease >= max(RATE_DECREASE_WINDOW, 1 / self.rate):
+                self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+                self.last_decrease = now
+            self.tokens = min(self.tokens, 0)
+            delay = retry_after(headers)
+            if delay is not None:
+                self.blocked_until = max(self.blocked_until, now + delay)
+            return True
+
+    def __str__(self):
+        return f"{self.rate:.2f} req/s, {self.throttled} throttled"
+
+
+limiters = dict()
+limiters_lock = threading.Lock()
+
+
+def get_limiter(url):
+    host = urlsplit(url).hostname
+    with limiters_lock:
+        if host not in limiters:
+            limiters[host] = TokenBucket(RATE_LIMITS.get(host, RATE_LIMIT))
+        return limiters[host]
+
+
+def limited_get(session, url, throttled=None, retries=RATE_RETRIES, **kwargs):
+    """session.get paced by the limiter of the host, throttled answers are retried up to `retries` times.
+
+    `throttled(response)` can flag answers that are throttled but do not carry a 429/503 status.
+    """
+    limiter = get_limiter(url)
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        response = session.get(url, **kwargs)
+        status = 429 if throttled is not None and throttled(response) else response.status_code
+        if not limiter.update(status, response.headers) or attempt == retries:
+            return response
+        response.close()
+
+
+def report():
+    with limiters_lock:
+        return ", ".join(f"{host}: {limiter}" for host, limiter in limiters.items())
@@ -0,0 +1,71 @@
+import html
+import re
+
+from bs4 import BeautifulSoup
+
+# Some archives answer with an HTML page that links to the actual memento instead of an HTTP redirect.
+# Those pages are tiny and always look the same, so the link is taken from the start of the body with a pattern and
+# the body is only parsed as a whole if the pattern is not conclusive.
+
+# Bytes of the body that are scanned
+REDIRECT_SCAN_BYTES = 64 * 1024
+
+HREF = rb"""<a\b[^>]*?\bhref\s*=\s*["']([^"']*)["']"""
+
+# archive: (marker of a redirect page, link after the marker), add an entry (and a case in parse_redirect) for
+# every archive with redirect pages. Other archives are negligible.
+REDIRECT_RULES = {
+    # <p class="impatient"><a href="...">
+    "congress": (re.compile(rb"""<p\b[^>]*\bclass\s*=\s*["']impatient["']""", re.I),
+                 re.compile(rb"""[^>]*>(?:(?!</p\b).)*?""" + HREF, re.I | re.S)),
+    # <div class="redirect"> ... <div> ... <a href="...">
+    "iceland": (re.compile(rb"""<div\b[^>]*\bclass\s*=\s*["']redirect["']""", re.I),
+                re.compile(rb"""[^>]*>(?:(?!</?div\b).)*<div\b[^>]*>(?:(?!</?div\b).)*?""" + HREF, re.I | re.S)),
+}
+
+
+def is_redirect_page(headers):
+    # If memento-timestamp exists and no x-archive-orig
+    # we have a redirect, else not
+    headers = [k.lower() for k in headers.keys()]
+    return "memento-datetime" in headers and "x-archive-orig" not in "".join(headers)
+
+
+def check_redirect(archive, content):
+    # check if a redirect page is shown.
+    # if so, return the URL it points to
+    if archive not in REDIRECT_RULES:
+        return ""
+    marker, link = REDIRECT_RULES[archive]
+    prefix = content[:REDIRECT_SCAN_BYTES]
+    markers = list(marker.finditer(prefix))
+    if not markers:
+        if len(content) <= REDIRECT_SCAN_BYTES:
+            # not valid
+            return ""
+    elif len(markers) == 1:
+        match = link.match(prefix, markers[0].end())
+        if match:
+            return html.unescape(match.group(1).decode("utf-8", errors="replace"))
+    # Truncated, repeated or unusual markup
+    return parse_redirect(archive, content)
+
+
+def parse_redirect(archive, content):
+    soup = BeautifulSoup(content, 'html.parser')
+
+    if archive == "congress":
+        results = soup.select("p[class='impatient']")
+        if len(results) == 0:
+            # not valid
+            return ""
+        redirect_url = str(results[0].find("a")['href'])
+    elif archive == "iceland":
+        results = soup.select("div[class='redirect']")
+        if len(results) == 0:
+            return ""
+        div = results[0].find("div")
+        redirect_url = str(div.find("a")['href'])
+    else:
+        redirect_url = ""
+    return redirect_url
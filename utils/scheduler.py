@@ -0,0 +1,156 @@
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from multiprocessing import Pool, current_process
+from multiprocessing.pool import ThreadPool
+
+from config import PROCESSES, POOL_MODE, THREADS, SCHEDULER_WINDOW, SCHEDULER_REPORT_INTERVAL
+
+# Fetch-bound collectors spend their time waiting for archives, in "thread" mode they run THREADS workers in one
+# process that share the content store, the rate limiters and the memory. "process" keeps one process per worker.
+# Work is handed out in small pieces as workers become free, so one slow archive or domain never leaves the
+# other workers idle while a statically assigned slice is still being worked off.
+
+
+def pool_size(processes=PROCESSES):
+    return THREADS if POOL_MODE == "thread" else processes
+
+
+def get_pool(processes=PROCESSES):
+    # ThreadPool and Pool share the same interface (map, starmap, imap_unordered, ...)
+    if POOL_MODE == "thread":
+        return ThreadPool(THREADS)
+    if POOL_MODE == "process":
+        return Pool(processes)
+    raise ValueError(f"Unknown pool mode {POOL_MODE}")
+
+
+def worker_name():
+    thread = threading.current_thread()
+    if thread is threading.main_thread():
+        return current_process().name
+    return thread.name
+
+
+class Throughput:
+    """Counts finished jobs and busy time per worker and prints a report every `interval` seconds."""
+
+    def __init__(self, name="", interval=SCHEDULER_REPORT_INTERVAL):
+        self.name = name
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+        self.counts = Counter()
+        self.busy = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, worker, seconds=0.0, n=1):
+        with self.lock:
+            self.counts[worker] += n
+            self.busy[worker] += seconds
+            due = time.time() - self.last_report >= self.interval
+            if due:
+                self.last_report = time.time()
+        if due:
+            print(self.report())
+
+    def report(self):
+        with self.lock:
+            elapsed = max(time.time() - self.start, 1e-9)
+            total = sum(self.counts.values())
+            lines = [f"{self.name}: {total} jobs in {elapsed:.0f}s ({total / elapsed:.2f}/s)"]
+            for worker, count in sorted(self.counts.items()):
+                lines.append(f"  {worker}: {count} ({count / elapsed:.2f}/s, {self.busy[worker] / elapsed:.0%} busy)")
+            return "\n".join(lines)
+
+
+class Progress:
+    """Counts finished jobs per key (e.g. the archive) against the work left and estimates when each key is done.
+
+    The keys are worked off in parallel, so the whole run ends with the slowest key.
+    """
+
+    def __init__(self, name, totals, interval=SCHEDULER_REPORT_INTERVAL):
+        self.name = name
+        self.totals = Counter(totals)
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+        self.done = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, key, n=1):
+        with self.lock:
+            self.done[key] += n
+            due = time.time() - self.last_report >= self.interval
+            if due:
+                self.last_report = time.time()
+        if due:
+            print(self.report())
+
+    def eta(self, key, elapsed):
+        left = max(self.totals[key] - self.done[key], 0)
+        if not left:
+            return 0
+        if not self.done[key]:
+            return None
+        return left * elapsed / self.done[key]
+
+    def report(self):
+        with self.lock:
+            elapsed = max(time.time() - self.start, 1e-9)
+            etas = {key: self.eta(key, elapsed) for key in self.totals}
+            lines = [f"{self.name}: {sum(self.done.values())}/{sum(self.totals.values())} jobs in {elapsed:.0f}s, "
+                     f"ETA {format_eta(None if None in etas.values() else max(etas.values(), default=0))}"]
+            for key, total in sorted(self.totals.items()):
+                done = self.done[key]
+                lines.append(f"  {key}: {done}/{total} ({done / elapsed:.2f}/s, ETA {format_eta(etas[key])})")
+            return "\n".join(lines)
+
+
+def format_eta(seconds):
+    return "unknown" if seconds is None else str(timedelta(seconds=round(seconds)))
+
+
+def timed_call(func, args):
+    start = time.time()
+    result = func(*args)
+    return worker_name(), time.time() - start, result
+
+
+def imap_unordered(pool, func, items, workers=None, throughput=None, window=SCHEDULER_WINDOW):
+    """Like pool.imap_unordered(func, items) for argument tuples, yields (item, result) as jobs finish.
+
+    Unlike the pool's own imap, items are pulled lazily: at most `window` jobs per worker are handed out at a time,
+    so claiming items from a job queue never runs ahead of the workers and every free worker picks the next job.
+    """
+    workers = workers or pool_size()
+    done = queue.Queue()
+    items = iter(items)
+    in_flight = 0
+
+    def submit():
+        try:
+            item = next(items)
+        except StopIteration:
+            return False
+        pool.apply_async(timed_call, (func, item),
+                         callback=lambda result, item=item: done.put((item, result, None)),
+                         error_callback=lambda error, item=item: done.put((item, None, error)))
+        return True
+
+    while in_flight < workers * window and submit():
+        in_flight += 1
+    while in_flight:
+        item, result, error = done.get()
+        in_flight -= 1
+        if submit():
+            in_flight += 1
+        if error is not None:
+            raise error
+        worker, seconds, value = result
+        if throughput is not None:
+            throughput.add(worker, seconds)
+        yield item, value
@@ -0,0 +1,645 @@
+import gzip
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from hashlib import sha256
+from io import BytesIO, StringIO
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from config import STORAGE, STORAGE_SEGMENT_SIZE, STORAGE_LAYOUT, STORAGE_CODEC, MAX_BODY_SIZE, STREAM_CHUNK_SIZE, \
+    ZSTD_LEVEL, ZSTD_DICT_SIZE, ZSTD_DICT_SAMPLES
+from utils.database import get_conn
+
+# Bodies are kept as compressed blobs appended to pack segments in STORAGE/packs.
+# STORAGE/index.sqlite maps every sha256 to the (segment, offset, length) of its blob.
+# Blobs of the old layout (STORAGE/<h0>/<h1>/<hash>.gz) stay readable until they are migrated,
+# and the store can still write that layout with layout='loose'.
+# Blobs are either gzip members or zstd frames, readers tell them apart by their magic bytes.
+# zstd frames may reference a dictionary (STORAGE/dicts/<dict_id>.zdict) that was trained per archive or domain.
+# The blob_meta table of the index keeps length, stored length, content type and charset of every blob,
+# so passes like updater.update_length never have to decompress anything.
+
+PACK_DIR = "packs"
+TMP_DIR = "tmp"
+DICT_DIR = "dicts"
+INDEX_NAME = "index.sqlite"
+
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+# Segments kept open for reading
+MAX_READERS = 64
+
+# Number of (decompressed) leading bytes that are looked at to guess content type and charset
+SNIFF_SIZE = 1024
+# Number of compressed bytes read to get those when the metadata of an existing blob is backfilled
+SNIFF_READ_SIZE = 8192
+
+MAGIC_TYPES = [
+    (b"%PDF-", "application/pdf"),
+    (b"\x89PNG", "image/png"),
+    (b"GIF8", "image/gif"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"<?xml", "application/xml"),
+    (b"<!doctype html", "text/html"),
+    (b"<html", "text/html"),
+    (b"<head", "text/html"),
+    (b"<!--", "text/html"),
+    (b"{", "application/json"),
+    (b"[", "application/json"),
+]
+BOMS = [(b"\xef\xbb\xbf", "utf-8"), (b"\xff\xfe", "utf-16le"), (b"\xfe\xff", "utf-16be")]
+META_CHARSET = re.compile(rb"<meta[^>]+charset\s*=\s*[\"']?\s*([\w.:-]+)", re.IGNORECASE)
+
+
+def loose_path(root, content_hash, codec="gzip"):
+    return os.path.join(root, content_hash[0], content_hash[1], f"{content_hash}{EXTENSIONS[codec]}")
+
+
+def sniff(prefix):
+    # Guess content type and charset from the first bytes of a body, archives often rewrite the Content-Type header
+    charset = None
+    for bom, name in BOMS:
+        if prefix.startswith(bom):
+            charset = name
+            prefix = prefix[len(bom):]
+            break
+    match = META_CHARSET.search(prefix)
+    if charset is None and match:
+        charset = match.group(1).decode("ascii", "replace").lower()
+
+    head = prefix.lstrip().lower()
+    for magic, content_type in MAGIC_TYPES:
+        if head.startswith(magic):
+            return content_type, charset
+    if b"<html" in head or b"<body" in head:
+        return "text/html", charset
+    try:
+        prefix.decode(charset or "utf-8")
+    except (UnicodeDecodeError, LookupError):
+        return ("text/plain" if charset else "application/octet-stream"), charset
+    return "text/plain", charset
+
+
+def dict_name(dict_key):
+    # dictionary keys are archive names or domains, keep them safe to use as file names
+    return re.sub(r"[^\w.-]", "_", str(dict_key))
+
+
+class ContentStore:
+
+    def __init__(self, root=STORAGE, segment_size=STORAGE_SEGMENT_SIZE, layout=STORAGE_LAYOUT, codec=STORAGE_CODEC):
+        if layout not in ("pack", "loose"):
+            raise ValueError(f"Unknown storage layout {layout}")
+        if codec not in EXTENSIONS:
+            raise ValueError(f"Unknown storage codec {codec}")
+        if codec == "zstd" and zstandard is None:
+            raise RuntimeError("The zstd codec needs the zstandard package")
+        self.root = root
+        self.segment_size = segment_size
+        self.layout = layout
+        self.codec = codec
+        self.pack_dir = os.path.join(root, PACK_DIR)
+        self.tmp_dir = os.path.join(root, TMP_DIR)
+        self.dict_dir = os.path.join(root, DICT_DIR)
+        os.makedirs(self.pack_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        os.makedirs(self.dict_dir, exist_ok=True)
+
+        # WAL lets all collector processes write to the index while readers keep going.
+        # Threads of one process share the connection and the open segment, self.lock serializes them.
+        self.lock = threading.RLock()
+        self.index = sqlite3.connect(os.path.join(root, INDEX_NAME), timeout=300, isolation_level=None,
+                                     check_same_thread=False)
+        self.index.execute("PRAGMA journal_mode=WAL")
+        self.index.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            )
+        """)
+        self.index.execute("""
+            CREATE TABLE IF NOT EXISTS blob_meta (
+                hash TEXT PRIMARY KEY,
+                length INTEGER NOT NULL,
+                stored_length INTEGER NOT NULL,
+                content_type TEXT,
+                charset TEXT
+            )
+        """)
+
+        self.segment = None
+        self.segment_name = None
+        self.segment_count = 0
+        self.readers = {}
+        self.stats = Counter()
+        self.compressors = {}
+        self.dictionaries = {}
+        self.decompressors = {}
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+        for fh in self.readers.values():
+            fh.close()
+        self.readers = {}
+        self.index.close()
+
+    def _open_segment(self):
+        # Every process appends to its own segment, so a segment never has two writers
+        if self.segment is not None:
+            self.segment.close()
+        self.segment_count += 1
+        self.segment_name = f"{time.strftime('%Y%m%d%H%M%S')}-{socket.gethostname()}-{os.getpid()}-" \
+                            f"{self.segment_count}.pack"
+        self.segment = open(os.path.join(self.pack_dir, self.segment_name), "ab")
+
+    def _append(self, content_hash, blob):
+        with self.lock:
+            if self.segment is None or self.segment.tell() >= self.segment_size:
+                self._open_segment()
+            offset = self.segment.tell()
+            if isinstance(blob, bytes):
+                self.segment.write(blob)
+            else:
+                shutil.copyfileobj(blob, self.segment, STREAM_CHUNK_SIZE)
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            length = self.segment.tell() - offset
+            # The index row is written last, a blob is only visible once it is durably in the segment.
+            # A crash before that leaves unreferenced bytes at the end of the segment, never a broken blob.
+            self.index.execute("INSERT OR IGNORE INTO blobs (hash, segment, offset, length) VALUES (?, ?, ?, ?)",
+                               (content_hash, self.segment_name, offset, length))
+            return length
+
+    def _locate(self, content_hash):
+        with self.lock:
+            return self.index.execute("SELECT segment, offset, length FROM blobs WHERE hash = ?",
+                                      (content_hash,)).fetchone()
+
+    def _read_packed(self, segment, offset, length):
+        with self.lock:
+            fh = self.readers.pop(segment, None)
+            if fh is None:
+                fh = open(os.path.join(self.pack_dir, segment), "rb")
+                if len(self.readers) >= MAX_READERS:
+                    # Passes over many segments would run out of file descriptors, the oldest one is closed
+                    self.readers.pop(next(iter(self.readers))).close()
+            # Most recently used last
+            self.readers[segment] = fh
+            fh.seek(offset)
+            return fh.read(length)
+
+    def _write_loose(self, content_hash, blob):
+        path = loose_path(self.root, content_hash, self.codec)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write next to the target and rename, so readers never see a partially written file
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(blob)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, path)
+
+    def _record_meta(self, content_hash, length, stored_length, prefix):
+        content_type, charset = sniff(prefix)
+        with self.lock:
+            self.index.execute("""
+                INSERT OR IGNORE INTO blob_meta (hash, length, stored_length, content_type, charset)
+                VALUES (?, ?, ?, ?, ?)
+            """, (content_hash, length, stored_length, content_type, charset))
+
+    def _store(self, content_hash, blob, content):
+        if self.layout == "pack":
+            self._append(content_hash, blob)
+        else:
+            self._write_loose(content_hash, blob)
+        self._record_meta(content_hash, len(content), len(blob), content[:SNIFF_SIZE])
+        self.stats["writes"] += 1
+        self.stats["bytes_written"] += len(blob)
+
+    def _store_file(self, content_hash, tmp_path, length, prefix):
+        # Takes over a fully written temp file from BlobWriter, synced if it is renamed into the loose layout
+        if self.exists(content_hash):
+            os.remove(tmp_path)
+            self.stats["duplicates"] += 1
+            self.stats["bytes_skipped"] += length
+            return
+        if self.layout == "pack":
+            with open(tmp_path, "rb") as fh:
+                stored = self._append(content_hash, fh)
+            os.remove(tmp_path)
+        else:
+            path = loose_path(self.root, content_hash, self.codec)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            stored = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        self._record_meta(content_hash, length, stored, prefix)
+        self.stats["writes"] += 1
+        self.stats["bytes_written"] += stored
+
+    def _load_dictionary(self, dict_id):
+        with open(os.path.join(self.dict_dir, f"{dict_id}.zdict"), "rb") as fh:
+            return zstandard.ZstdCompressionDict(fh.read())
+
+    def _dict_id(self, dict_key):
+        # Plain zstd as long as no dictionary was trained for dict_key
+        if dict_key is None:
+            return 0
+        pointer = os.path.join(self.dict_dir, f"{dict_name(dict_key)}.key")
+        if not os.path.exists(pointer):
+            return 0
+        with open(pointer) as fh:
+            return int(fh.read())
+
+    def _compression_dictionary(self, dict_id):
+        # Loaded and digested once per dictionary, the digested form is read-only and shared by all compressors
+        with self.lock:
+            if dict_id not in self.dictionaries:
+                zdict = self._load_dictionary(dict_id)
+                zdict.precompute_compress(level=ZSTD_LEVEL)
+                self.dictionaries[dict_id] = zdict
+            return self.dictionaries[dict_id]
+
+    def new_compressor(self, dict_key=None):
+        # For a single stream, see BlobWriter
+        dict_id = self._dict_id(dict_key)
+        dict_data = self._compression_dictionary(dict_id) if dict_id else None
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=dict_data)
+
+    def compressor(self, dict_key=None):
+        # zstd (de)compressors must not be used by two threads at once, so they are cached per thread.
+        # Only for one-shot compress(), every open stream needs a compressor of its own.
+        key = (threading.get_ident(), self._dict_id(dict_key))
+        if key not in self.compressors:
+            self.compressors[key] = self.new_compressor(dict_key)
+        return self.compressors[key]
+
+    def compress(self, content, dict_key=None):
+        if self.codec == "zstd":
+            return self.compressor(dict_key).compress(content)
+        return gzip.compress(content)
+
+    def decompress(self, blob):
+        if blob[:4] == ZSTD_MAGIC:
+            if zstandard is None:
+                raise RuntimeError("Reading zstd blobs needs the zstandard package")
+            # Streamed frames carry no content size, so decompress() cannot be used for them
+            return self._decompressor(blob).decompressobj().decompress(blob)
+        return gzip.decompress(blob)
+
+    def _decompressor(self, blob):
+        dict_id = zstandard.get_frame_parameters(blob).dict_id
+        key = (threading.get_ident(), dict_id)
+        if key not in self.decompressors:
+            dict_data = self._load_dictionary(dict_id) if dict_id else None
+            self.decompressors[key] = zstandard.ZstdDecompressor(dict_data=dict_data)
+        return self.decompressors[key]
+
+    def train_dictionary(self, dict_key, hashes, dict_size=ZSTD_DICT_SIZE):
+        if zstandard is None:
+            raise RuntimeError("Training dictionaries needs the zstandard package")
+        samples = []
+        for content_hash in hashes:
+            try:
+                samples.append(self.get(content_hash))
+            except FileNotFoundError:
+                continue
+        if len(samples) < 10:
+            print(f"Not enough samples for {dict_key} ({len(samples)})")
+            return None
+        zdict = zstandard.train_dictionary(dict_size, samples)
+        dict_id = zdict.dict_id()
+        # Dictionaries are never overwritten, old frames keep referencing theirs by id
+        path = os.path.join(self.dict_dir, f"{dict_id}.zdict")
+        with open(f"{path}.tmp", "wb") as fh:
+            fh.write(zdict.as_bytes())
+        os.replace(f"{path}.tmp", path)
+        pointer = os.path.join(self.dict_dir, f"{dict_name(dict_key)}.key")
+        with open(f"{pointer}.tmp", "w") as fh:
+            fh.write(str(dict_id))
+        os.replace(f"{pointer}.tmp", pointer)
+        print(f"Trained dictionary {dict_id} for {dict_key} from {len(samples)} samples")
+        return dict_id
+
+    def train_from_table(self, table, column, samples=ZSTD_DICT_SAMPLES):
+        # One dictionary per distinct value of column, e.g. arch for per-archive or url for per-domain dictionaries
+        conn = get_conn()
+        cur = conn.cursor()
+        cur.execute(f"SELECT DISTINCT {column} FROM {table} WHERE content_hash IS NOT NULL")
+        keys = [key for key, in cur.fetchall()]
+        for key in keys:
+            cur.execute(f"""
+                SELECT DISTINCT content_hash FROM {table}
+                WHERE {column} = %s AND content_hash IS NOT NULL
+                LIMIT %s
+            """, (key, samples))
+            self.train_dictionary(key, [h for h, in cur.fetchall()])
+        cur.close()
+        conn.close()
+
+    def writer(self, max_size=MAX_BODY_SIZE, dict_key=None):
+        return BlobWriter(self, max_size, dict_key)
+
+    def put_stream(self, chunks, max_size=MAX_BODY_SIZE, dict_key=None):
+        writer = self.writer(max_size, dict_key)
+        try:
+            for chunk in chunks:
+                if not writer.write(chunk):
+                    break
+        except BaseException:
+            writer.abort()
+            raise
+        content_hash = writer.commit()
+        return content_hash, writer.length, writer.truncated
+
+    def put(self, content, dict_key=None):
+        content_hash = sha256(content).hexdigest()
+        # Archive error pages and neighbour snapshots are often byte-identical, skip the compression for those
+        if self.exists(content_hash):
+            self.stats["duplicates"] += 1
+            self.stats["bytes_skipped"] += len(content)
+            return content_hash
+        self._store(content_hash, self.compress(content, dict_key), content)
+        return content_hash
+
+    def report(self):
+        total = self.stats["writes"] + self.stats["duplicates"]
+        if total == 0:
+            return "no blobs stored"
+        return f"{self.stats['duplicates']}/{total} duplicates ({100 * self.stats['duplicates'] / total:.1f}%), " \
+               f"{self.stats['bytes_written'] / 1024 ** 2:.1f} MiB written, " \
+               f"{self.stats['bytes_skipped'] / 1024 ** 2:.1f} MiB skipped"
+
+    def exists(self, content_hash):
+        if self._locate(content_hash) is not None:
+            return True
+        return any(os.path.exists(loose_path(self.root, content_hash, codec)) for codec in EXTENSIONS)
+
+    def get_compressed(self, content_hash):
+        location = self._locate(content_hash)
+        if location is not None:
+            return self._read_packed(*location)
+        for codec in EXTENSIONS:
+            path = loose_path(self.root, content_hash, codec)
+            if os.path.exists(path):
+                with open(path, "rb") as fh:
+                    return fh.read()
+        raise FileNotFoundError(f"{content_hash} is not in the content store")
+
+    def get(self, content_hash):
+        return self.decompress(self.get_compressed(content_hash))
+
+    def open(self, content_hash):
+        return BytesIO(self.get(content_hash))
+
+    def meta(self, content_hash):
+        with self.lock:
+            row = self.index.execute("SELECT length, stored_length, content_type, charset FROM blob_meta WHERE hash = ?",
+                                     (content_hash,)).fetchone()
+        if row is None:
+            return self.describe(content_hash)
+        return dict(zip(("length", "stored_length", "content_type", "charset"), row))
+
+    def describe(self, content_hash):
+        # Fills in the metadata of a blob that was stored without it, reading as little of the blob as possible
+        location = self._locate(content_hash)
+        if location is not None:
+            segment, offset, stored = location
+
+            def read(start, size):
+                return self._read_packed(segment, offset + start, size)
+        else:
+            path = next((loose_path(self.root, content_hash, codec) for codec in EXTENSIONS
+                         if os.path.exists(loose_path(self.root, content_hash, codec))), None)
+            if path is None:
+                raise FileNotFoundError(f"{content_hash} is not in the content store")
+            stored = os.path.getsize(path)
+
+            def read(start, size):
+                with open(path, "rb") as fh:
+                    fh.seek(start)
+                    return fh.read(size)
+
+        head = read(0, min(stored, SNIFF_READ_SIZE))
+        if head[:4] == ZSTD_MAGIC:
+            length = zstandard.get_frame_parameters(head).content_size
+            if length == zstandard.CONTENTSIZE_UNKNOWN:
+                # frames written by BlobWriter do not carry their size
+                content = self.get(content_hash)
+                length, prefix = len(content), content[:SNIFF_SIZE]
+            else:
+                prefix = self._decompressor(head).decompressobj().decompress(head)[:SNIFF_SIZE]
+        else:
+            # ISIZE, the last 4 bytes of a gzip member, is the uncompressed length modulo 2^32
+            length = int.from_bytes(read(stored - 4, 4), "little")
+            prefix = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head, SNIFF_SIZE)
+        self._record_meta(content_hash, length, stored, prefix)
+        content_type, charset = sniff(prefix)
+        return {"length": length, "stored_length": stored, "content_type": content_type, "charset": charset}
+
+    def lengths(self, hashes):
+        # Uncompressed lengths of many blobs at once, blobs without metadata are described on the way
+        result = {}
+        hashes = list(hashes)
+        for i in range(0, len(hashes), 500):
+            batch = hashes[i:i + 500]
+            rows = self.index.execute(f"SELECT hash, length FROM blob_meta WHERE hash IN ({','.join('?' * len(batch))})",
+                                      batch).fetchall()
+            result.update(rows)
+        for content_hash in hashes:
+            if content_hash not in result:
+                try:
+                    result[content_hash] = self.describe(content_hash)["length"]
+                except FileNotFoundError:
+                    continue
+        return result
+
+    def backfill(self):
+        described = 0
+        missing = self.index.execute("""
+            SELECT hash FROM blobs WHERE hash NOT IN (SELECT hash FROM blob_meta)
+        """).fetchall()
+        for content_hash, in missing:
+            self.describe(content_hash)
+            described += 1
+        for content_hash, path in self._loose_blobs():
+            if self.index.execute("SELECT 1 FROM blob_meta WHERE hash = ?", (content_hash,)).fetchone() is None:
+                self.describe(content_hash)
+                described += 1
+                if described % 10000 == 0:
+                    print(f"Described {described} blobs")
+        print(f"Described {described} blobs")
+        return described
+
+    def _loose_blobs(self):
+        for h0 in sorted(os.listdir(self.root)):
+            if len(h0) != 1 or not os.path.isdir(os.path.join(self.root, h0)):
+                continue
+            for h1 in sorted(os.listdir(os.path.join(self.root, h0))):
+                bucket = os.path.join(self.root, h0, h1)
+                if len(h1) != 1 or not os.path.isdir(bucket):
+                    continue
+                for name in os.listdir(bucket):
+                    content_hash, ext = os.path.splitext(name)
+                    if ext in EXTENSIONS.values():
+                        yield content_hash, os.path.join(bucket, name)
+
+    def migrate(self, remove=False):
+        # Move a loose <h0>/<h1>/<hash>.gz|.zst tree into pack segments, the blobs are copied as they are
+        broken = (OSError, EOFError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+        migrated = 0
+        for content_hash, path in self._loose_blobs():
+            if self._locate(content_hash) is None:
+                with open(path, "rb") as fh:
+                    blob = fh.read()
+                try:
+                    content = self.decompress(blob)
+                except broken:
+                    # Left behind by a crash during a non-atomic write
+                    print(f"Skipping truncated blob {path}")
+                    continue
+                self._append(content_hash, blob)
+                self._record_meta(content_hash, len(content), len(blob), content[:SNIFF_SIZE])
+            if remove:
+                os.remove(path)
+            migrated += 1
+            if migrated % 10000 == 0:
+                print(f"Migrated {migrated} blobs")
+        print(f"Migrated {migrated} blobs")
+        return migrated
+
+
+class BlobWriter:
+    """Hashes and compresses a body chunk by chunk into a temp file that is moved into the store on commit."""
+
+    def __init__(self, store, max_size=MAX_BODY_SIZE, dict_key=None):
+        self.store = store
+        self.max_size = max_size
+        self.hash = sha256()
+        self.length = 0
+        self.truncated = False
+        self.prefix = b""
+        fd, self.tmp_path = tempfile.mkstemp(dir=store.tmp_dir, suffix=".tmp")
+        self.tmp = os.fdopen(fd, "wb")
+        if store.codec == "zstd":
+            # Writers of concurrent fetches are created on the same thread, a shared compressor would interleave
+            # their frames
+            self.compressed = store.new_compressor(dict_key).stream_writer(self.tmp, closefd=False)
+        else:
+            self.compressed = gzip.GzipFile(fileobj=self.tmp, mode="wb", mtime=0)
+
+    def write(self, chunk):
+        # Returns False once max_size is reached, everything after that is dropped
+        if self.truncated:
+            return False
+        if self.max_size is not None and self.length + len(chunk) > self.max_size:
+            chunk = chunk[:self.max_size - self.length]
+            self.truncated = True
+        self.hash.update(chunk)
+        if len(self.prefix) < SNIFF_SIZE:
+            self.prefix += chunk[:SNIFF_SIZE - len(self.prefix)]
+        self.compressed.write(chunk)
+        self.length += len(chunk)
+        return not self.truncated
+
+    def commit(self):
+        self.compressed.close()
+        content_hash = self.hash.hexdigest()
+        # Only a loose blob is renamed into place as it is, a packed one is copied into the segment and synced there.
+        # Known bodies are dropped by _store_file, they need no fsync either
+        if self.store.layout == "loose" and not self.store.exists(content_hash):
+            self.tmp.flush()
+            os.fsync(self.tmp.fileno())
+        self.tmp.close()
+        self.store._store_file(content_hash, self.tmp_path, self.length, self.prefix)
+        return content_hash
+
+    def abort(self):
+        self.compressed.close()
+        self.tmp.close()
+        os.remove(self.tmp_path)
+
+
+stores = {}
+stores_lock = threading.Lock()
+
+
+def get_store(root=STORAGE):
+    # sqlite connections and open segments must not be shared with forked pool workers, threads share one store
+    key = (os.getpid(), root)
+    with stores_lock:
+        if key not in stores:
+            stores[key] = ContentStore(root)
+        return stores[key]
+
+
+def put(content, dict_key=None):
+    return get_store().put(content, dict_key)
+
+
+def get(content_hash):
+    return get_store().get(content_hash)
+
+
+def exists(content_hash):
+    return get_store().exists(content_hash)
+
+
+def open_content(content_hash):
+    return get_store().open(content_hash)
+
+
+def report():
+    return get_store().report()
+
+
+def meta(content_hash):
+    return get_store().meta(content_hash)
+
+
+def copy_lengths(cur, hashes, table="content_lengths"):
+    # Loads the sidecar lengths of hashes into a temporary table, ready for a set-based UPDATE ... FROM
+    lengths = get_store().lengths(hashes)
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {table} (content_hash VARCHAR(64) PRIMARY KEY, length INTEGER)")
+    data = StringIO("".join(f"{content_hash}\t{length}\n" for content_hash, length in lengths.items()))
+    cur.copy_from(data, table, columns=("content_hash", "length"))
+    return len(lengths)
+
+
+def main():
+    usage = "Usage: python -m utils.storage migrate [root] [--remove]\n" \
+            "       python -m utils.storage backfill [root]\n" \
+            "       python -m utils.storage train <table> <column> [samples]"
+    if len(sys.argv) < 2:
+        print(usage)
+    elif sys.argv[1] == "migrate":
+        args = [a for a in sys.argv[2:] if a != "--remove"]
+        root = args[0] if args else STORAGE
+        get_store(root).migrate(remove="--remove" in sys.argv)
+    elif sys.argv[1] == "backfill":
+        get_store(sys.argv[2] if len(sys.argv) > 2 else STORAGE).backfill()
+    elif sys.argv[1] == "train" and len(sys.argv) >= 4:
+        samples = int(sys.argv[4]) if len(sys.argv) > 4 else ZSTD_DICT_SAMPLES
+        get_store().train_from_table(sys.argv[2], sys.argv[3], samples)
+    else:
+        print(usage)
+
+
+if __name__ == '__main__':
+    main()